@@ -1,11 +1,50 @@
+import datetime
+import functools
 import json
-import logging
+import time
+
 import discord
 import websockets
 import asyncio
-import threading
 import pycountry
-from redbot.core import commands
+import aiohttp
+from aiohttp import web
+from owidlib import ConnectionSupervisor, runtime
+from redbot.core import commands, Config, checks
+from redbot.core.data_manager import cog_data_path
+
+from .eventlog import EventLog
+
+UNIQUE_ID = 0x49504E
+# Fields build_embed can't do without, notifications such as subscr_signup lack some of them
+REQUIRED_FIELDS = ('first_name', 'last_name', 'mc_gross', 'mc_currency', 'payer_email', 'residence_country',
+                   'txn_id', 'payment_status', 'ipn_track_id', 'payment_date')
+# Failed sends are retried with an exponential backoff, starting at RETRY_DELAY seconds
+DELIVERY_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+
+
+@functools.lru_cache(maxsize=None)
+def country_name(alpha_2):
+    country = pycountry.countries.get(alpha_2=alpha_2)
+    return country.name if country else alpha_2
+
+
+def check_payload(data):
+    """Why a notification can't be posted, None if it can"""
+    if not isinstance(data, dict):
+        return f"Not an object: {type(data).__name__}"
+    missing = [field for field in REQUIRED_FIELDS if field not in data]
+    if missing:
+        return f"Missing {', '.join(missing)}"
+    return None
+
+
+def is_rejection(error):
+    """Whether Discord refused the message itself, sending it again won't help
+
+    Missing access or channels are left out, they are fixed on our side and the notifications replayed"""
+    return 400 <= error.status < 500 and error.status not in (401, 403, 404, 429)
 
 
 class IPN(commands.Cog):
@@ -14,65 +53,373 @@ class IPN(commands.Cog):
         super().__init__(*args, **kwargs)
 
         self.bot = bot
-        self.socket_task = self.bot.loop.create_task(self.wsrun())
-        self.log = logging.getLogger("red")
-        self.stop_event = threading.Event()
-        self.stop = self.bot.loop.run_in_executor(None, self.stop_event.wait)
+        self.log = runtime.get_logger("IPN")
+        self.config = Config.get_conf(self, identifier=UNIQUE_ID, force_registration=True)
+        self.config.register_global(channel=830267832889114644, queue_size=1000, workers=2,
+                                    batch_size=1, batch_window=2.0, http_port=0, log_level='INFO')
+        runtime.acquire()
+
+        self.queue = None
+        self.events = None
+        self.pending = set()
+        # Held while logging notifications and while replaying them, so both can't queue the same event
+        self.log_lock = asyncio.Lock()
+        self.workers = []
+        self.http_runner = None
+        self.supervisor = ConnectionSupervisor("IPN", self.wsrun, self.log)
+        self.channel_id = None
+        self.batch_size = 1
+        self.batch_window = 2.0
+        self.stats = {'received': 0, 'duplicates': 0, 'delivered': 0, 'failed': 0, 'retries': 0, 'dead': 0,
+                      'batches': 0, 'full_waits': 0, 'full_wait_time': 0.0, 'high_watermark': 0, 'max_latency': 0.0}
+        self.main_task = self.bot.loop.create_task(self.initialize())
 
         #loop = asyncio.get_event_loop()
         #loop.run_until_complete(self.wsrun())
 
+    async def initialize(self):
+        settings = await self.config.all()
+        runtime.set_log_level("IPN", settings['log_level'])
+        self.channel_id = settings['channel']
+        self.batch_size = settings['batch_size']
+        self.batch_window = settings['batch_window']
+        self.queue = asyncio.Queue(maxsize=settings['queue_size'])
+        self.events = await runtime.run_io(EventLog, cog_data_path(self) / "events.db")
+        # pycountry loads its whole database on first use, get that out of the way off the loop
+        await runtime.run_io(country_name, 'ID')
+
+        for _ in range(max(1, settings['workers'])):
+            self.workers.append(self.bot.loop.create_task(self.worker()))
+
+        # Deliver whatever was left over from the previous run
+        await self.bot.wait_until_red_ready()
+        await self.replay_undelivered()
+
+        self.supervisor.start(self.bot.loop)
+        if settings['http_port']:
+            await self.http_run(settings['http_port'])
+
+    async def receive(self, data):
+        """Record an incoming notification and queue it for delivery unless it is a retransmission"""
+        self.stats['received'] += 1
+        dead = check_payload(data)
+        if dead and not isinstance(data, dict):
+            self.stats['dead'] += 1
+            self.log.warning(f"Ignoring unusable notification: {dead}")
+            return
+
+        async with self.log_lock:
+            event_id = await runtime.run_io(self.events.append, data, dead)
+            if event_id is not None and not dead:
+                self.pending.add(event_id)
+        if event_id is None:
+            self.stats['duplicates'] += 1
+            self.log.debug(f"Ignoring duplicate notification {data.get('txn_id')}")
+            return
+        if dead:
+            self.stats['dead'] += 1
+            self.log.warning(f"Not posting notification #{event_id} ({data.get('txn_type', 'unknown type')}): {dead}")
+            return
+        await self.enqueue(event_id, data)
+
+    async def enqueue(self, event_id, data):
+        """Hand a notification over to the delivery workers, waiting if the queue is full"""
+        self.pending.add(event_id)
+        item = (time.monotonic(), event_id, data)
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.stats['full_waits'] += 1
+            started = time.monotonic()
+            await self.queue.put(item)
+            self.stats['full_wait_time'] += time.monotonic() - started
+        self.stats['high_watermark'] = max(self.stats['high_watermark'], self.queue.qsize())
+
     async def listen(self, websocket, path):
         try:
-            self.log.debug("[IPN] Client connection established")
+            self.log.debug("Client connection established")
             while True:
                 msg = await websocket.recv()
-                data = json.loads(msg)
-
-                self.log.debug(f"[IPN] < {msg}")
-                embed = discord.Embed(color=0xCBC3E3, title='Payment from %s %s' % (data['first_name'], data['last_name']))
-                # embed.set_author(name='%s %s' % (data['first_name'], data['last_name']), icon_url='https://cdn.discordapp.com/embed/avatars/0.png')
-                embed.add_field(name='Payment Received', value='%s %s' % (data['mc_gross'], data['mc_currency']), inline=True)
-
-                if 'mc_fee' in data:
-                    embed.add_field(name='Fee', value='%s %s' % (data['mc_fee'], data['mc_currency']), inline=True)
-
-                embed.add_field(name='E-mail Address', value=data['payer_email'], inline=False)
-                embed.add_field(name='Country', value='%s (%s)' % (pycountry.countries.get(alpha_2=data['residence_country']).name, data['residence_country']), inline=False)
-                embed.add_field(name='Transaction ID', value=data['txn_id'], inline=False)
-                # embed.add_field(name='Date', value=data['payment_date'], inline=False)
-                embed.add_field(name='Status', value=data['payment_status'], inline=False)
-                embed.set_image(url="https://i.pinimg.com/originals/f3/e0/5e/f3e05e008d8d5e0eda6c0fa8f559ab28.gif")
-                embed.set_thumbnail(url='https://i.imgur.com/Mz2rAzF.png')
-                embed.set_footer(text='Track ID: %s | %s' % (data['ipn_track_id'].upper(), data['payment_date']))
-                embed.url = 'https://www.paypal.com/activity/payment/%s' % data['txn_id']
-                await self.bot.get_channel(830267832889114644).send(embed=embed)
-
+                self.log.debug(f"< {msg}")
+                await self.receive(json.loads(msg))
                 await websocket.send("Hello")
         except (websockets.exceptions.ConnectionClosedError, websockets.exceptions.ConnectionClosed):
-            self.log.debug("[IPN] Client connection closed")
+            self.log.debug("Client connection closed")
 
-    async def wsrun(self):
+    async def http_listen(self, request):
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.log.debug(f"< {data}")
+        await self.receive(data)
+        return web.Response(text="OK")
+
+    async def http_run(self, port):
+        app = web.Application()
+        app.router.add_post('/ipn', self.http_listen)
+        self.http_runner = web.AppRunner(app)
+        await self.http_runner.setup()
+        await web.TCPSite(self.http_runner, "localhost", port).start()
+        self.log.debug(f"Serving HTTP endpoint on port {port}")
+
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_size > 1:
+                deadline = loop.time() + self.batch_window
+                while len(batch) < self.batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+            try:
+                await self.send_batch(batch)
+            except Exception as e:
+                self.stats['failed'] += len(batch)
+                self.log.warning(f"Unable to deliver {len(batch)} notification(s): {str(e)}")
+            finally:
+                for _, event_id, _ in batch:
+                    self.pending.discard(event_id)
+                    self.queue.task_done()
+
+    async def send_batch(self, batch):
+        """Deliver a batch, giving up on the notifications Discord refuses"""
         try:
-            self.log.debug("[IPN] Serving websocket on port 8887")
-            async with websockets.serve(self.listen, "localhost", 8887):
-                await self.stop
-            while True:
-                await asyncio.sleep(1)
-        except asyncio.exceptions.TimeoutError:
-            self.log.warning("[IPN] Attempting to reconnect due to connection timeout")
-            await self.wsrun()
-        except websockets.exceptions.ConnectionClosed:
-            self.log.warning("[IPN] Attempting to reconnect due to connection closed")
-            await self.wsrun()
-        except Exception as e:
-            self.log.warning("[IPN] Attempting to reconnect due to: " + str(e))
-            await self.wsrun()
+            await self.deliver_with_retry(batch)
+        except discord.HTTPException as e:
+            if not is_rejection(e):
+                raise
+            if len(batch) == 1:
+                await self.give_up(batch, e)
+                return
+            # Find the notifications the batch was refused for
+            for item in batch:
+                await self.send_batch([item])
+
+    async def give_up(self, batch, error):
+        """Mark notifications Discord refused as dead so they are never replayed"""
+        reason = f"Refused by Discord: {error.status} {error.text}"
+        await runtime.run_io(self.events.mark_dead, [(event_id, reason) for _, event_id, _ in batch])
+        self.stats['dead'] += len(batch)
+        self.log.warning(f"Giving up on {len(batch)} notification(s): {reason}")
+
+    async def deliver_with_retry(self, batch):
+        """Deliver a batch, retrying server errors, rate limits and network errors with a backoff"""
+        for attempt in range(DELIVERY_ATTEMPTS):
+            try:
+                return await self.deliver(batch)
+            except (discord.HTTPException, aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                transient = not isinstance(e, discord.HTTPException) or e.status >= 500 or e.status == 429
+                if not transient or attempt == DELIVERY_ATTEMPTS - 1:
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                self.stats['retries'] += 1
+                self.log.info(f"Unable to deliver {len(batch)} notification(s), retrying in {delay:.0f}s: {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def deliver(self, batch):
+        if len(batch) == 1:
+            embed = self.build_embed(batch[0][2])
+        else:
+            embed = self.build_batch_embed([data for _, _, data in batch])
+
+        await self.bot.get_channel(self.channel_id).send(embed=embed)
+        await runtime.run_io(self.events.mark_delivered, [event_id for _, event_id, _ in batch])
+
+        now = time.monotonic()
+        self.stats['delivered'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['max_latency'] = max(self.stats['max_latency'], max(now - queued for queued, _, _ in batch))
+
+    async def replay_undelivered(self):
+        """Queue every logged notification that has not been posted yet, returns the amount queued"""
+        async with self.log_lock:
+            events = await runtime.run_io(self.events.undelivered)
+            replayed, dead = [], []
+            for event_id, data in events:
+                if event_id in self.pending:
+                    continue
+                reason = check_payload(data)
+                if reason:
+                    dead.append((event_id, reason))
+                else:
+                    replayed.append((event_id, data))
+                    self.pending.add(event_id)
+
+        if dead:
+            # Logged before payloads were checked on arrival
+            await runtime.run_io(self.events.mark_dead, dead)
+            self.stats['dead'] += len(dead)
+            self.log.warning(f"Not replaying {len(dead)} unusable notification(s)")
+        for event_id, data in replayed:
+            await self.enqueue(event_id, data)
+        if replayed:
+            self.log.info(f"Replaying {len(replayed)} undelivered notification(s)")
+        return len(replayed)
+
+    @staticmethod
+    def build_embed(data):
+        embed = discord.Embed(color=0xCBC3E3, title='Payment from %s %s' % (data['first_name'], data['last_name']))
+        # embed.set_author(name='%s %s' % (data['first_name'], data['last_name']), icon_url='https://cdn.discordapp.com/embed/avatars/0.png')
+        embed.add_field(name='Payment Received', value='%s %s' % (data['mc_gross'], data['mc_currency']), inline=True)
+
+        if 'mc_fee' in data:
+            embed.add_field(name='Fee', value='%s %s' % (data['mc_fee'], data['mc_currency']), inline=True)
+
+        embed.add_field(name='E-mail Address', value=data['payer_email'], inline=False)
+        embed.add_field(name='Country', value='%s (%s)' % (country_name(data['residence_country']), data['residence_country']), inline=False)
+        embed.add_field(name='Transaction ID', value=data['txn_id'], inline=False)
+        # embed.add_field(name='Date', value=data['payment_date'], inline=False)
+        embed.add_field(name='Status', value=data['payment_status'], inline=False)
+        embed.set_image(url="https://i.pinimg.com/originals/f3/e0/5e/f3e05e008d8d5e0eda6c0fa8f559ab28.gif")
+        embed.set_thumbnail(url='https://i.imgur.com/Mz2rAzF.png')
+        embed.set_footer(text='Track ID: %s | %s' % (data['ipn_track_id'].upper(), data['payment_date']))
+        embed.url = 'https://www.paypal.com/activity/payment/%s' % data['txn_id']
+        return embed
+
+    @staticmethod
+    def build_batch_embed(batch):
+        embed = discord.Embed(color=0xCBC3E3, title='%d payments received' % len(batch))
+        # Discord allows at most 25 fields per embed
+        for data in batch[:25]:
+            embed.add_field(name='%s %s' % (data['first_name'], data['last_name']),
+                            value='[%s %s](https://www.paypal.com/activity/payment/%s) - %s' % (
+                                data['mc_gross'], data['mc_currency'], data['txn_id'], data['payment_status']),
+                            inline=False)
+        if len(batch) > 25:
+            embed.set_footer(text='and %d more..' % (len(batch) - 25))
+        embed.set_thumbnail(url='https://i.imgur.com/Mz2rAzF.png')
+        return embed
+
+    async def wsrun(self, supervisor):
+        self.log.debug("Serving websocket on port 8887")
+        async with websockets.serve(self.listen, "localhost", 8887):
+            supervisor.connected()
+            # Serve until the supervisor gets cancelled
+            await asyncio.Future()
 
     def cog_unload(self):
-        self.log.debug("[IPN] Shutting down websocket server..")
-        self.stop_event.set()
-        self.socket_task.cancel()
+        self.log.debug("Shutting down websocket server..")
+        self.main_task.cancel()
+        self.supervisor.stop()
+        for worker in self.workers:
+            worker.cancel()
+        if self.http_runner:
+            self.bot.loop.create_task(self.http_runner.cleanup())
+        if self.events:
+            self.events.close()
+        runtime.release()
+
+    @commands.group()
+    @checks.is_owner()
+    async def ipn(self, ctx: commands.Context) -> None:
+        """
+        PayPal IPN commands
+        """
+        pass
+
+    @ipn.group(name="set")
+    async def ipn_set(self, ctx: commands.Context) -> None:
+        """
+        Set up IPN configurations
+        """
+        pass
+
+    @ipn.command(name="stats")
+    async def ipn_stats(self, ctx: commands.Context):
+        """Show ingestion queue statistics"""
+        queued = self.queue.qsize() if self.queue else 0
+        maxsize = self.queue.maxsize if self.queue else 0
+        embed = discord.Embed(color=0xCBC3E3, title='IPN statistics')
+        embed.add_field(name='Queue', value=f"{queued}/{maxsize} (peak {self.stats['high_watermark']})")
+        embed.add_field(name='Workers', value=str(len(self.workers)))
+        embed.add_field(name='Websocket server', value=self.supervisor.describe(), inline=False)
+        embed.add_field(name='Received', value=f"{self.stats['received']} ({self.stats['duplicates']} duplicate(s))")
+        embed.add_field(name='Delivered', value=f"{self.stats['delivered']} in {self.stats['batches']} message(s)")
+        embed.add_field(name='Failed', value=f"{self.stats['failed']} ({self.stats['retries']} retries)")
+        embed.add_field(name='Dead', value=str(self.stats['dead']))
+        embed.add_field(name='Backpressure', value=f"{self.stats['full_waits']} wait(s), "
+                                                   f"{self.stats['full_wait_time']:.2f}s total")
+        embed.add_field(name='Max latency', value=f"{self.stats['max_latency']:.2f}s")
+        await ctx.send(embed=embed)
+
+    @ipn.command()
+    async def replay(self, ctx: commands.Context):
+        """Re-queue logged notifications that were never posted"""
+        count = await self.replay_undelivered()
+        await ctx.send(f"Replaying {count} undelivered notification(s)" if count else "No undelivered notifications")
+
+    @ipn.command()
+    async def lookup(self, ctx: commands.Context, transaction_id: str):
+        """Look up logged notifications by transaction or track ID"""
+        events = await runtime.run_io(self.events.lookup, transaction_id)
+        if not events:
+            await ctx.send("Transaction not found")
+            return
+
+        for event in events[:5]:
+            if event['dead']:
+                embed = discord.Embed(color=0xCBC3E3, title='Unusable notification', description=event['dead'])
+                embed.add_field(name='Type', value=event['data'].get('txn_type', 'unknown'), inline=False)
+            else:
+                embed = self.build_embed(event['data'])
+            received = datetime.datetime.utcfromtimestamp(event['received'])
+            delivered = datetime.datetime.utcfromtimestamp(event['delivered']) if event['delivered'] else None
+            embed.add_field(name='Logged', value=f"#{event['id']} at {received:%Y-%m-%d %H:%M:%S} UTC", inline=True)
+            embed.add_field(name='Delivered', value=f"{delivered:%Y-%m-%d %H:%M:%S} UTC" if delivered else 'No',
+                            inline=True)
+            await ctx.send(embed=embed)
+
+    @ipn_set.command()
+    async def loglevel(self, ctx: commands.Context, level: str):
+        """Set the log level of this cog"""
+        if not runtime.set_log_level("IPN", level):
+            await ctx.send(f"Log level should be one of: {', '.join(runtime.LOG_LEVELS)}")
+            return
+        await self.config.log_level.set(level.upper())
+        await ctx.send(f"Log level set to {level.upper()}")
+
+    @ipn_set.command()
+    async def channel(self, ctx: commands.Context, channel: discord.TextChannel):
+        """Set the channel payment notifications are posted to"""
+        await self.config.channel.set(channel.id)
+        self.channel_id = channel.id
+        await ctx.send(f"Notification channel set to <#{channel.id}>")
+
+    @ipn_set.command()
+    async def batch(self, ctx: commands.Context, size: int, window: float = 2.0):
+        """Group up to `size` notifications arriving within `window` seconds into one message
+
+        A size of 1 disables batching"""
+        size = max(1, min(size, 25))
+        await self.config.batch_size.set(size)
+        await self.config.batch_window.set(window)
+        self.batch_size = size
+        self.batch_window = window
+        await ctx.send(f"Batch size set to {size} with a {window}s window")
+
+    @ipn_set.command(name="queue")
+    async def set_queue(self, ctx: commands.Context, size: int, workers: int = 2):
+        """Set the ingestion queue size and the number of delivery workers
+
+        Takes effect after the cog is reloaded"""
+        await self.config.queue_size.set(max(1, size))
+        await self.config.workers.set(max(1, workers))
+        await ctx.send(f"Queue size set to {max(1, size)} with {max(1, workers)} worker(s), reload the cog to apply")
+
+    @ipn_set.command()
+    async def http(self, ctx: commands.Context, port: int):
+        """Set the HTTP ingestion port, 0 disables the endpoint
+
+        Takes effect after the cog is reloaded"""
+        await self.config.http_port.set(port)
+        await ctx.send(f"HTTP endpoint port set to {port}, reload the cog to apply")
 
 
 #IPN(None)
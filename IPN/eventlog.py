@@ -0,0 +1,78 @@
+import json
+import time
+
+from owidlib import SQLiteStore
+
+
+class EventLog(SQLiteStore):
+    """Append-only SQLite log of received IPN messages
+
+    Every message is recorded before it is queued for delivery and is only marked
+    as delivered once it has been posted, so nothing is lost across restarts.
+    Messages that can never be posted are recorded as dead with the reason and
+    are left out of the replays.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                txn_id TEXT NOT NULL,
+                ipn_track_id TEXT NOT NULL,
+                received REAL NOT NULL,
+                delivered REAL,
+                payload TEXT NOT NULL,
+                dead TEXT
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS events_dedup ON events (txn_id, ipn_track_id);
+            CREATE INDEX IF NOT EXISTS events_txn ON events (txn_id);
+            CREATE INDEX IF NOT EXISTS events_track ON events (ipn_track_id);
+            CREATE INDEX IF NOT EXISTS events_pending ON events (id) WHERE delivered IS NULL;
+        """)
+        columns = {column[1] for column in self.db.execute("PRAGMA table_info(events)")}
+        if 'dead' not in columns:
+            self.db.execute("ALTER TABLE events ADD COLUMN dead TEXT")
+
+    def append(self, data, dead=None):
+        """Record a message, returns its event id or None if it was already recorded
+
+        `dead` is the reason a message can't be posted, it is then never replayed."""
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO events (txn_id, ipn_track_id, received, payload, dead) VALUES (?, ?, ?, ?, ?)",
+                (data.get('txn_id', ''), data.get('ipn_track_id', ''), time.time(), json.dumps(data), dead)
+            )
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def mark_delivered(self, event_ids):
+        now = time.time()
+        with self.transaction():
+            self.db.executemany("UPDATE events SET delivered = ? WHERE id = ?",
+                                [(now, event_id) for event_id in event_ids])
+
+    def mark_dead(self, reasons):
+        """Give up on events, `reasons` are (event id, reason) pairs"""
+        with self.transaction():
+            self.db.executemany("UPDATE events SET dead = ? WHERE id = ?",
+                                [(reason, event_id) for event_id, reason in reasons])
+
+    def undelivered(self, limit=None):
+        query = "SELECT id, payload FROM events WHERE delivered IS NULL AND dead IS NULL ORDER BY id"
+        if limit:
+            query += " LIMIT %d" % int(limit)
+        with self.lock:
+            rows = self.db.execute(query).fetchall()
+        return [(event_id, json.loads(payload)) for event_id, payload in rows]
+
+    def lookup(self, transaction_id):
+        """Find events by either their txn_id or ipn_track_id"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, received, delivered, dead, payload FROM events WHERE txn_id = ? "
+                "UNION SELECT id, received, delivered, dead, payload FROM events WHERE ipn_track_id IN (?, ?) "
+                "ORDER BY id",
+                (transaction_id, transaction_id, transaction_id.lower())
+            ).fetchall()
+        return [{'id': event_id, 'received': received, 'delivered': delivered, 'dead': dead,
+                 'data': json.loads(payload)}
+                for event_id, received, delivered, dead, payload in rows]
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import re
+import resource
+import tempfile
+import time
+import tracemalloc
+
+
+def setup_red(path=None):
+    """Point Red's data manager at a throwaway folder so cogs can use Config without a running bot"""
+    from redbot.core import data_manager
+
+    path = path or tempfile.mkdtemp(prefix='owid-bench-')
+    data_manager.basic_config = dict(data_manager.basic_config_default, DATA_PATH=path)
+    return path
+
+
+class SinkChannel:
+    """Stands in for every Discord channel, records when each message would have been sent
+
+    Messages are searched for `pattern` so each send can be matched with the
+    notifications it carries, `latency` simulates the Discord API round-trip."""
+
+    def __init__(self, pattern, latency=0.0):
+        self.id = 0
+        self.name = 'bench'
+        self.pattern = re.compile(pattern)
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, content=None, embed=None, file=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        text = json.dumps(embed.to_dict()) if embed is not None else str(content)
+        self.sent.append((time.monotonic(), self.pattern.findall(text)))
+
+
+class StubBot:
+    def __init__(self, sink):
+        self.loop = asyncio.get_event_loop()
+        self.sink = sink
+        self.guilds = []
+
+    async def wait_until_red_ready(self):
+        pass
+
+    def get_channel(self, channel_id):
+        return self.sink
+
+
+class Recorder:
+    """Remembers when each notification left the load generator"""
+
+    def __init__(self):
+        self.emitted = {}
+
+    def mark(self, key):
+        self.emitted[key] = time.monotonic()
+
+    def latencies(self, sink):
+        latencies = {}
+        for sent, keys in sink.sent:
+            for key in keys:
+                if key in self.emitted and key not in latencies:
+                    latencies[key] = sent - self.emitted[key]
+        return list(latencies.values())
+
+    async def drain(self, sink, timeout=30.0):
+        """Wait until every emitted notification reached the sink, or give up after `timeout` seconds"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if len(self.latencies(sink)) >= len(self.emitted):
+                return True
+            await asyncio.sleep(0.1)
+        return False
+
+
+class MemorySampler:
+    """Samples traced Python memory and the process peak RSS every `interval` seconds"""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    def sample(self):
+        current, peak = tracemalloc.get_traced_memory()
+        # ru_maxrss is in kilobytes on Linux
+        self.samples.append((time.monotonic(), current, peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        tracemalloc.start()
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.task.cancel()
+        self.sample()
+        tracemalloc.stop()
+
+    def summary(self):
+        first, last = self.samples[0], self.samples[-1]
+        return {
+            'traced_start_kb': first[1] // 1024,
+            'traced_end_kb': last[1] // 1024,
+            'traced_peak_kb': max(sample[2] for sample in self.samples) // 1024,
+            'max_rss_kb': last[3],
+        }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def paced(rate, burst, duration):
+    """Yield the index of every burst, `burst` notifications at a time averaging `rate` per second"""
+    interval = burst / rate
+    started = time.monotonic()
+    index = 0
+    while time.monotonic() - started < duration:
+        yield index
+        index += 1
+        delay = started + index * interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def report(name, results, as_json=False):
+    if as_json:
+        print(json.dumps({'benchmark': name, **results}, indent=2))
+        return
+
+    print(f"== {name} ==")
+    for key, value in results.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items())
+        elif isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"{key:>20}: {value}")
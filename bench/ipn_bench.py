@@ -0,0 +1,178 @@
+"""Load test of the IPN cog through its websocket server
+
+    python -m bench.ipn_bench --rate 50 --burst 10 --duration 60 --connections 4 [--payloads recorded.jsonl]
+
+Recorded IPN payloads (one JSON object per line, synthetic ones by default) are
+replayed with fresh transaction ids at the given rate and burst size, delivered
+by the cog's real queue and workers to a stub Discord channel. Reports
+throughput, notification to send latency, how long clients take to get back
+in after the websocket server restarts and memory over the run.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+
+import websockets
+
+from .common import MemorySampler, Recorder, SinkChannel, StubBot, paced, percentile, report, setup_red
+
+IPN_URI = 'ws://localhost:8887'
+SAMPLE_PAYLOAD = {
+    'first_name': 'Bench',
+    'last_name': 'Mark',
+    'mc_gross': '10.00',
+    'mc_fee': '0.64',
+    'mc_currency': 'USD',
+    'payer_email': 'bench@example.com',
+    'residence_country': 'ID',
+    'payment_status': 'Completed',
+    'payment_date': '00:00:00 Jan 01, 2021 PST',
+}
+
+
+def load_payloads(path):
+    if not path:
+        return [SAMPLE_PAYLOAD]
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Client:
+    """One websocket connection to the cog, reconnects whenever the server goes away
+
+    The cog acknowledges every notification, a connection carries one at a time."""
+
+    def __init__(self, recoveries):
+        self.recoveries = recoveries
+        self.websocket = None
+        self.lost_at = None
+        self.lock = asyncio.Lock()
+
+    async def send(self, payload):
+        async with self.lock:
+            await self.deliver(payload)
+
+    async def deliver(self, payload):
+        while True:
+            try:
+                if self.websocket is None:
+                    self.websocket = await websockets.connect(IPN_URI)
+                await self.websocket.send(json.dumps(payload))
+                await self.websocket.recv()
+            except (OSError, websockets.exceptions.ConnectionClosed):
+                self.websocket = None
+                if self.lost_at is None:
+                    self.lost_at = time.monotonic()
+                await asyncio.sleep(0.05)
+                continue
+
+            if self.lost_at is not None:
+                self.recoveries.append(time.monotonic() - self.lost_at)
+                self.lost_at = None
+            return
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+
+
+async def generate(clients, payloads, recorder, rate, burst, duration):
+    payloads = itertools.cycle(payloads)
+    clients = itertools.cycle(clients)
+    pending = set()
+    async for _ in paced(rate, burst, duration):
+        for _ in range(burst):
+            txn_id = uuid.uuid4().hex[:17].upper()
+            payload = dict(next(payloads), txn_id=txn_id, ipn_track_id=uuid.uuid4().hex[:13])
+            recorder.mark(txn_id)
+            pending.add(asyncio.ensure_future(next(clients).send(payload)))
+        pending = {task for task in pending if not task.done()}
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def restart_periodically(cog, every):
+    while True:
+        await asyncio.sleep(every)
+        cog.supervisor.task.cancel()
+        await asyncio.wait([cog.supervisor.task])
+        cog.supervisor.start()
+
+
+async def run(args):
+    from IPN.IPN import IPN
+
+    setup_red()
+    sink = SinkChannel(r'activity/payment/(\w+)', latency=args.send_latency)
+    cog = IPN(StubBot(sink))
+    # Configure before the cog reads its settings
+    cog.main_task.cancel()
+    await cog.config.queue_size.set(args.queue_size)
+    await cog.config.workers.set(args.workers)
+    await cog.config.batch_size.set(args.batch_size)
+    await cog.config.batch_window.set(args.batch_window)
+    await cog.initialize()
+    while cog.supervisor.state != 'connected':
+        await asyncio.sleep(0.01)
+
+    memory = MemorySampler(args.memory_interval)
+    memory.start()
+
+    recorder = Recorder()
+    recoveries = []
+    clients = [Client(recoveries) for _ in range(args.connections)]
+    restarter = asyncio.ensure_future(restart_periodically(cog, args.restart_every)) if args.restart_every else None
+    started = time.monotonic()
+    await generate(clients, load_payloads(args.payloads), recorder, args.rate, args.burst, args.duration)
+    if restarter:
+        restarter.cancel()
+    drained = await recorder.drain(sink, timeout=30)
+    elapsed = time.monotonic() - started
+    memory.stop()
+
+    latencies = recorder.latencies(sink)
+    report('ipn', {
+        'emitted': len(recorder.emitted),
+        'delivered': len(latencies),
+        'drained': drained,
+        'messages': len(sink.sent),
+        'throughput_per_s': len(latencies) / elapsed,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': max(latencies, default=0.0),
+        'reconnects': len(recoveries),
+        'recovery_p50_s': percentile(recoveries, 50),
+        'recovery_max_s': max(recoveries, default=0.0),
+        'memory': memory.summary(),
+        'stats': cog.stats,
+    }, args.json)
+
+    for client in clients:
+        await client.close()
+    cog.cog_unload()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=50.0, help="notifications per second")
+    parser.add_argument('--burst', type=int, default=1, help="notifications sent back to back")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to generate load for")
+    parser.add_argument('--connections', type=int, default=4, help="concurrent websocket clients")
+    parser.add_argument('--payloads', help="JSON lines file of recorded IPN payloads to replay")
+    parser.add_argument('--restart-every', type=float, default=0.0,
+                        help="restart the websocket server this often, 0 never")
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--batch-window', type=float, default=2.0)
+    parser.add_argument('--send-latency', type=float, default=0.05, help="simulated Discord send time")
+    parser.add_argument('--memory-interval', type=float, default=5.0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import time
+
+import websockets
+
+DONATION_EVENT = 'Illuminate\\Notifications\\Events\\BroadcastNotificationCreated'
+
+
+class PusherServer:
+    """Local stand-in for the Pusher websocket protocol as spoken by trakteer.id
+
+    Acknowledges subscriptions, answers pings and broadcasts donation events to
+    the subscribers of a channel. `drop()` closes every client connection to
+    measure how long the clients take to come back."""
+
+    def __init__(self, host='localhost', port=0, activity_timeout=120):
+        self.host = host
+        self.port = port
+        self.activity_timeout = activity_timeout
+        self.server = None
+        self.clients = set()
+        self.subscriptions = {}
+        self.messages = 0
+
+    @property
+    def uri(self):
+        return f"ws://{self.host}:{self.port}/app/bench"
+
+    async def start(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handler(self, websocket, path=None):
+        self.clients.add(websocket)
+        try:
+            await websocket.send(json.dumps({
+                'event': 'pusher:connection_established',
+                'data': json.dumps({'socket_id': f"{id(websocket)}.1", 'activity_timeout': self.activity_timeout}),
+            }))
+            async for message in websocket:
+                message = json.loads(message)
+                event = message.get('event')
+                data = message.get('data') or {}
+                if event == 'pusher:subscribe':
+                    self.subscriptions.setdefault(data['channel'], set()).add(websocket)
+                    await websocket.send(json.dumps({'event': 'pusher_internal:subscription_succeeded',
+                                                     'channel': data['channel'], 'data': '{}'}))
+                elif event == 'pusher:unsubscribe':
+                    self.subscriptions.get(data['channel'], set()).discard(websocket)
+                elif event == 'pusher:ping':
+                    await websocket.send(json.dumps({'event': 'pusher:pong', 'data': {}}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(websocket)
+            for subscribers in self.subscriptions.values():
+                subscribers.discard(websocket)
+
+    def subscribed(self, channels):
+        return all(self.subscriptions.get(channel) for channel in channels)
+
+    async def wait_subscribed(self, channels, timeout=600.0):
+        """Seconds it took until every channel had a subscriber again, None on timeout"""
+        started = time.monotonic()
+        while not self.subscribed(channels):
+            if time.monotonic() - started > timeout:
+                return None
+            await asyncio.sleep(0.01)
+        return time.monotonic() - started
+
+    async def broadcast(self, channel, data):
+        """Send a donation to the subscribers of a channel, returns False if nobody is listening"""
+        subscribers = list(self.subscriptions.get(channel, ()))
+        message = json.dumps({'event': DONATION_EVENT, 'channel': channel, 'data': json.dumps(data)})
+        for websocket in subscribers:
+            try:
+                await websocket.send(message)
+                self.messages += 1
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        return bool(subscribers)
+
+    async def drop(self):
+        for websocket in list(self.clients):
+            await websocket.close()
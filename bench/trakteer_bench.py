@@ -0,0 +1,130 @@
+"""Load test of the Trakteer cog against a local Pusher server
+
+    python -m bench.trakteer_bench --creators 20 --rate 20 --burst 5 --duration 60 --drop-every 20
+
+Donations are broadcast by the local server, received by the cog's real Pusher
+connections and posted to a stub Discord channel. Reports throughput, donation
+to send latency, how long the connections take to resubscribe after being
+dropped and memory over the run.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+from .common import MemorySampler, Recorder, SinkChannel, StubBot, paced, percentile, report, setup_red
+from .pusher_server import PusherServer
+
+
+def make_creators(count):
+    return [{'channelId': i,
+             'channelKey': f"creator-stream.bench{i}.trstream-bench",
+             'channelUrl': f"https://trakteer.id/bench-{i}",
+             'debug': False} for i in range(count)]
+
+
+async def generate(server, creators, recorder, rate, burst, duration):
+    counter = itertools.count()
+    channels = itertools.cycle([creator['channelKey'] for creator in creators])
+    lost = 0
+    async for _ in paced(rate, burst, duration):
+        for _ in range(burst):
+            supporter = f"supporter-{next(counter)}"
+            recorder.mark(supporter)
+            delivered = await server.broadcast(next(channels), {
+                'supporter_name': supporter,
+                'supporter_avatar': 'https://trakteer.id/images/mix/default-avatar.png',
+                'supporter_message': 'bench',
+                'price': 'Rp 10.000',
+                'unit_icon': 'https://trakteer.id/images/mix/coffee.png',
+            })
+            if not delivered:
+                # Pusher does not replay events sent while a client was away
+                del recorder.emitted[supporter]
+                lost += 1
+    return lost
+
+
+async def drop_periodically(server, channels, every, recoveries):
+    while True:
+        await asyncio.sleep(every)
+        await server.drop()
+        recovery = await server.wait_subscribed(channels)
+        if recovery is not None:
+            recoveries.append(recovery)
+
+
+async def run(args):
+    from trakteer.trakteer import Trakteer
+
+    server = PusherServer()
+    await server.start()
+    setup_red()
+
+    sink = SinkChannel(r'supporter-\d+', latency=args.send_latency)
+    cog = Trakteer(StubBot(sink))
+    # Configure before the cog reads its settings
+    cog.main_task.cancel()
+    cog.pusher_uri = server.uri
+    creators = make_creators(args.creators)
+    await cog.config.creators.set(creators)
+    await cog.config.coalesce_window.set(args.coalesce)
+    await cog.initialize()
+
+    channels = [channel for creator in creators for channel in cog.get_channels(creator)]
+    connected = await server.wait_subscribed(channels, timeout=60)
+    memory = MemorySampler(args.memory_interval)
+    memory.start()
+
+    recorder = Recorder()
+    recoveries = []
+    dropper = asyncio.ensure_future(drop_periodically(server, channels, args.drop_every, recoveries)) \
+        if args.drop_every else None
+    started = time.monotonic()
+    lost = await generate(server, creators, recorder, args.rate, args.burst, args.duration)
+    if dropper:
+        dropper.cancel()
+    drained = await recorder.drain(sink, timeout=args.coalesce + 30)
+    elapsed = time.monotonic() - started
+    memory.stop()
+
+    latencies = recorder.latencies(sink)
+    report('trakteer', {
+        'connections': len(cog.connections),
+        'initial_subscribe_s': connected,
+        'emitted': len(recorder.emitted) + lost,
+        'lost_while_down': lost,
+        'delivered': len(latencies),
+        'drained': drained,
+        'messages': len(sink.sent),
+        'throughput_per_s': len(latencies) / elapsed,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': max(latencies, default=0.0),
+        'reconnects': len(recoveries),
+        'recovery_p50_s': percentile(recoveries, 50),
+        'recovery_max_s': max(recoveries, default=0.0),
+        'memory': memory.summary(),
+        'stats': cog.stats,
+    }, args.json)
+
+    cog.cog_unload()
+    await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--creators', type=int, default=20, help="creators to subscribe to")
+    parser.add_argument('--rate', type=float, default=20.0, help="donations per second")
+    parser.add_argument('--burst', type=int, default=1, help="donations sent back to back")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to generate load for")
+    parser.add_argument('--drop-every', type=float, default=0.0, help="drop every connection this often, 0 never")
+    parser.add_argument('--coalesce', type=float, default=0.0, help="coalescing window of the cog")
+    parser.add_argument('--send-latency', type=float, default=0.05, help="simulated Discord send time")
+    parser.add_argument('--memory-interval', type=float, default=5.0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
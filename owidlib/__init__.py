@@ -0,0 +1,4 @@
+from . import runtime
+from .supervisor import ConnectionSupervisor
+from .watchdog import LoopWatchdog
+from .sqlite import SQLiteStore, open_db
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from .watchdog import watchdog
+
+# Blocking network and disk work spends most of its time waiting, CPU bound work
+# (image transcoding and the like) should not oversubscribe the machine
+EXECUTOR_SIZES = {
+    'io': 16,
+    'cpu': max(1, (os.cpu_count() or 2) - 1),
+}
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+_users = 0
+_session = None
+_executors = {}
+
+
+def acquire():
+    """Register a cog as a user of the shared runtime, call `release()` from `cog_unload`"""
+    global _users
+    _users += 1
+    watchdog.start()
+
+
+def release():
+    """Drop a user of the shared runtime, the last one out closes the session and executors"""
+    global _users, _session
+    _users = max(0, _users - 1)
+    if _users:
+        return
+
+    if _session is not None and not _session.closed:
+        asyncio.ensure_future(_session.close())
+    _session = None
+
+    for executor in _executors.values():
+        executor.shutdown(wait=False)
+    _executors.clear()
+    watchdog.stop()
+
+
+def get_session():
+    """The pooled aiohttp session shared by every cog, keeps connections alive and caches DNS lookups"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=60, sock_connect=10, sock_read=30)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+def get_executor(name):
+    if name not in _executors:
+        _executors[name] = ThreadPoolExecutor(max_workers=EXECUTOR_SIZES[name], thread_name_prefix=f"owid-{name}")
+    return _executors[name]
+
+
+def run_in(name, func, *args, **kwargs):
+    """Run a blocking function in one of the named executors, returns an awaitable future"""
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(name), functools.partial(func, *args, **kwargs))
+
+
+def run_io(func, *args, **kwargs):
+    return run_in('io', func, *args, **kwargs)
+
+
+def run_cpu(func, *args, **kwargs):
+    return run_in('cpu', func, *args, **kwargs)
+
+
+class CogLogger(logging.LoggerAdapter):
+    """Prefixes every record with the cog name and renders `fields=` as trailing key=value pairs"""
+
+    def process(self, msg, kwargs):
+        fields = kwargs.pop('fields', None)
+        if fields:
+            msg = f"{msg} " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return f"[{self.extra['cog']}] {msg}", kwargs
+
+
+def get_logger(name):
+    return CogLogger(logging.getLogger(f"red.owid.{name.lower()}"), {'cog': name})
+
+
+def set_log_level(name, level):
+    """Apply a level from `LOG_LEVELS` to a cog logger, returns False for unknown levels"""
+    level = str(level).upper()
+    if level not in LOG_LEVELS:
+        return False
+    logging.getLogger(f"red.owid.{name.lower()}").setLevel(level)
+    return True
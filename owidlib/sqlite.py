@@ -0,0 +1,40 @@
+import contextlib
+import sqlite3
+import threading
+
+
+def open_db(path, schema, timeout=5.0):
+    """Open a SQLite database in WAL mode with autocommit, usable from any thread, and apply `schema`"""
+    db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=timeout)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(schema)
+    return db
+
+
+class SQLiteStore:
+    """Base of the SQLite stores used by the cogs
+
+    All methods of a store are blocking and meant to be run in an executor,
+    `lock` serialises the executor threads sharing the connection.
+    """
+
+    def __init__(self, path, schema, timeout=5.0):
+        self.lock = threading.Lock()
+        self.db = open_db(path, schema, timeout)
+
+    @contextlib.contextmanager
+    def transaction(self, mode=''):
+        """Hold the lock for a BEGIN .. COMMIT block, rolled back if it raises"""
+        with self.lock:
+            self.db.execute(f"BEGIN {mode}")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
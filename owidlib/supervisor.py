@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import random
+import time
+
+
+class ConnectionSupervisor:
+    """Keeps a long-running connection coroutine alive
+
+    `runner` is called with the supervisor as its only argument, should call
+    `connected()` once the connection is usable and should only return or raise
+    when the connection is gone. It is then restarted in a loop with exponential
+    backoff and jitter, the backoff only resets once a connection stayed up for
+    `stable_after` seconds so a flapping network cannot cause a reconnect storm.
+    """
+
+    def __init__(self, name, runner, log=None, base_delay=1.0, max_delay=300.0, stable_after=60.0):
+        self.name = name
+        self.runner = runner
+        self.log = log or logging.getLogger("red")
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+
+        self.task = None
+        self.state = 'idle'
+        self.failures = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.connected_at = None
+        self.retry_at = None
+
+    def start(self, loop=None):
+        if self.task is None or self.task.done():
+            loop = loop or asyncio.get_event_loop()
+            self.task = loop.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.state = 'stopped'
+
+    def connected(self):
+        self.state = 'connected'
+        self.connected_at = time.time()
+        self.retry_at = None
+
+    def backoff(self):
+        # "Equal jitter": never sleep less than half of the exponential delay
+        delay = min(self.max_delay, self.base_delay * 2 ** min(self.failures, 16))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def run(self):
+        while True:
+            self.state = 'connecting'
+            self.connected_at = None
+            try:
+                await self.runner(self)
+                error = 'connection ended'
+            except asyncio.CancelledError:
+                self.state = 'stopped'
+                raise
+            except asyncio.TimeoutError:
+                error = 'connection timeout'
+            except Exception as e:
+                error = f"{type(e).__name__}: {str(e)}"
+
+            if self.connected_at is not None and time.time() - self.connected_at >= self.stable_after:
+                self.failures = 0
+
+            delay = self.backoff()
+            self.failures += 1
+            self.reconnects += 1
+            self.last_error = error
+            self.state = 'backoff'
+            self.retry_at = time.time() + delay
+            self.log.warning(f"Reconnecting {self.name} in {delay:.1f}s due to: {error}")
+            await asyncio.sleep(delay)
+
+    def health(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'uptime': time.time() - self.connected_at if self.connected_at else None,
+            'reconnects': self.reconnects,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'retry_in': max(0.0, self.retry_at - time.time()) if self.retry_at else None,
+        }
+
+    def describe(self):
+        """One line human readable summary of `health()`"""
+        health = self.health()
+        if health['state'] == 'connected':
+            status = f"connected for {int(health['uptime'])}s"
+        elif health['state'] == 'backoff':
+            status = f"retrying in {int(health['retry_in'])}s"
+        else:
+            status = health['state']
+        status += f", {health['reconnects']} reconnect(s)"
+        if health['last_error']:
+            status += f", last error: {health['last_error']}"
+        return status
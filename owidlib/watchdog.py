@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+# Frames of the event loop machinery itself say nothing about who is blocking it
+IGNORED_MODULES = ('asyncio', 'selectors', 'threading', 'concurrent')
+
+
+class LoopWatchdog:
+    """Measures event loop lag and samples the loop's stack whenever a callback blocks it
+
+    A coroutine on the loop bumps a heartbeat every `interval` seconds and records
+    how late it woke up. A daemon thread checks that heartbeat and, once it is
+    more than `threshold` seconds stale, captures the loop thread's current stack
+    so the offending code shows up in `offenders()`.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25, history=600, max_offenders=100):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_offenders = max_offenders
+        self.lags = collections.deque(maxlen=history)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.samples = {}
+        self.lock = threading.Lock()
+
+        self.loop = None
+        self.loop_thread = None
+        self.heartbeat = time.monotonic()
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, loop=None):
+        """Start watching, must be called from the event loop's thread"""
+        if self.running:
+            return
+        self.loop = loop or asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = self.loop.create_task(self.tick())
+        self.thread = threading.Thread(target=self.monitor, name="owid-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def tick(self):
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - expected)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.heartbeat = time.monotonic()
+
+    def monitor(self):
+        last_stall = None
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+
+            # Every sample of the same stall has the same heartbeat
+            new_stall = heartbeat != last_stall
+            last_stall = heartbeat
+            if new_stall:
+                self.stalls += 1
+            self.record(stack, stalled, new_stall)
+
+    def record(self, stack, stalled, new_stall):
+        culprit = next((entry for entry in reversed(stack)
+                        if not any(f"{module}/" in entry.filename.replace('\\', '/') or
+                                   entry.filename.endswith(f"{module}.py") for module in IGNORED_MODULES)),
+                       stack[-1])
+        key = (culprit.filename, culprit.lineno, culprit.name)
+        with self.lock:
+            self.update(key, culprit, stack, stalled, new_stall)
+
+    def update(self, key, culprit, stack, stalled, new_stall):
+        sample = self.samples.get(key)
+        if sample is None:
+            if len(self.samples) >= self.max_offenders:
+                # Forget the least harmful offender to keep memory bounded
+                del self.samples[min(self.samples, key=lambda k: self.samples[k]['worst'])]
+            sample = self.samples[key] = {'location': f"{culprit.filename}:{culprit.lineno} in {culprit.name}",
+                                          'stalls': 0, 'samples': 0, 'worst': 0.0, 'stack': None}
+        sample['samples'] += 1
+        if new_stall:
+            sample['stalls'] += 1
+        if stalled >= sample['worst']:
+            sample['worst'] = stalled
+            sample['stack'] = "".join(traceback.format_list(stack[-8:]))
+
+    def lag(self):
+        """Current, median, 99th percentile and maximum loop lag in seconds"""
+        lags = sorted(self.lags)
+        if not lags:
+            return {'current': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': self.max_lag}
+        return {'current': self.lags[-1], 'p50': lags[len(lags) // 2],
+                'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))], 'max': self.max_lag}
+
+    def offenders(self, limit=5):
+        with self.lock:
+            samples = [dict(sample) for sample in self.samples.values()]
+        return sorted(samples, key=lambda sample: sample['worst'], reverse=True)[:limit]
+
+    def reset(self):
+        self.lags.clear()
+        self.max_lag = 0.0
+        self.stalls = 0
+        with self.lock:
+            self.samples.clear()
+
+
+watchdog = LoopWatchdog()
@@ -0,0 +1,6 @@
+from .owidtools import OWIDTools
+
+
+def setup(bot):
+    n = OWIDTools(bot)
+    bot.add_cog(n)
@@ -0,0 +1,60 @@
+import io
+
+import discord
+from owidlib import runtime
+from owidlib.watchdog import watchdog
+from redbot.core import commands, checks
+
+
+class OWIDTools(commands.Cog):
+    """ Diagnostics for the OWID cogs """
+
+    def __init__(self, bot, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bot = bot
+        runtime.acquire()
+
+    def cog_unload(self):
+        runtime.release()
+
+    @commands.group()
+    @checks.is_owner()
+    async def owid(self, ctx: commands.Context) -> None:
+        """
+        OWID diagnostics commands
+        """
+        pass
+
+    @owid.command()
+    async def loop(self, ctx: commands.Context, limit: int = 5):
+        """Show event loop lag and the code that blocked the loop the longest"""
+        lag = watchdog.lag()
+        embed = discord.Embed(color=0xEE2222, title='Event loop')
+        embed.description = f"Lag now {lag['current'] * 1000:.1f}ms, p50 {lag['p50'] * 1000:.1f}ms, " \
+                            f"p99 {lag['p99'] * 1000:.1f}ms, max {lag['max'] * 1000:.1f}ms\n" \
+                            f"{watchdog.stalls} stall(s) over {watchdog.threshold * 1000:.0f}ms"
+
+        offenders = watchdog.offenders(limit)
+        for sample in offenders:
+            embed.add_field(name=f"{sample['worst']:.2f}s worst, {sample['stalls']} stall(s)",
+                            value=f"`{sample['location'][-200:]}`", inline=False)
+
+        if not offenders:
+            await ctx.send(embed=embed)
+            return
+
+        report = "\n\n".join(f"{sample['location']} ({sample['worst']:.2f}s worst, {sample['stalls']} stall(s))\n"
+                             f"{sample['stack']}" for sample in offenders)
+        await ctx.send(embed=embed, file=discord.File(io.BytesIO(report.encode()), filename="offenders.txt"))
+
+    @owid.command()
+    async def threshold(self, ctx: commands.Context, milliseconds: int):
+        """Set how long the loop has to be blocked before its stack is sampled"""
+        watchdog.threshold = max(10, milliseconds) / 1000
+        await ctx.send(f"Blocking threshold set to {watchdog.threshold * 1000:.0f}ms")
+
+    @owid.command()
+    async def reset(self, ctx: commands.Context):
+        """Forget the collected lag statistics and offenders"""
+        watchdog.reset()
+        await ctx.send("Watchdog statistics cleared!")
@@ -1,7 +1,7 @@
-import aiohttp
 import asyncio
 import discord
 import gspread_asyncio
+from owidlib import runtime
 from redbot.core import Config, commands, checks
 from redbot.core.data_manager import cog_data_path
 from google.oauth2.service_account import Credentials
@@ -15,17 +15,21 @@ class Pugs(commands.Cog):
         super().__init__()
         self.bot = bot
         self.path = str(cog_data_path(self)).replace("\\", "/")
+        self.log = runtime.get_logger("pugs")
         self.config = Config.get_conf(self, identifier=123999999, force_registration=True)
 
         default_global = {
             'title': 'Overwatch PUG',
-            'googleCredentials': self.path + '/My First Project-162dbc0aa595.json'
+            'googleCredentials': self.path + '/My First Project-162dbc0aa595.json',
+            'logLevel': 'INFO'
         }
 
         self.config.register_global(**default_global)
+        runtime.acquire()
 
     async def initialize(self):
         self.credentials = await self.config.googleCredentials()
+        runtime.set_log_level("pugs", await self.config.logLevel())
 
         # Create an AsyncioGspreadClientManager object which
         # will give us access to the Spreadsheet API.
@@ -44,6 +48,9 @@ class Pugs(commands.Cog):
         ])
         return scoped
 
+    def cog_unload(self):
+        runtime.release()
+
     @staticmethod
     def parse_role(role):
         return {
@@ -77,6 +84,12 @@ class Pugs(commands.Cog):
         elif cmd == "credentials":
             await self.config.googleCredentials.set(value)
             await ctx.send("Credentials PUG telah berhasil diganti menjadi: **%s**" % value)
+        elif cmd == "loglevel":
+            if not runtime.set_log_level("pugs", value):
+                await ctx.send("Log level harus salah satu dari: **%s**" % ", ".join(runtime.LOG_LEVELS))
+                return
+            await self.config.logLevel.set(value.upper())
+            await ctx.send("Log level PUG telah berhasil diganti menjadi: **%s**" % value.upper())
 
     @commands.command()
     async def daftar(self, ctx, battle_tag, primary_role, secondary_role=None):
@@ -109,16 +122,18 @@ class Pugs(commands.Cog):
         async with ctx.typing():
             url = 'https://ow-api.com/v1/stats/pc/us/%s/profile' % (battle_tag.replace("#", "-"))
             hdr = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=hdr) as resp:
-                    if resp.headers.get('content-type') == 'application/json':
-                        data = await resp.json()
-                    else:
-                        embed = discord.Embed(color=0xEE2222, title="Terjadi kesalahan")
-                        embed.description = "Mohon coba lagi dalam beberapa menit.\nUnexpected content-type response from the API."
-                        embed.set_author(name=title, icon_url='https://i.imgur.com/kgrkybF.png')
-                        await ctx.send(content=ctx.message.author.mention, embed=embed)
-                        return None
+            async with runtime.get_session().get(url, headers=hdr) as resp:
+                if resp.headers.get('content-type') == 'application/json':
+                    data = await resp.json()
+                else:
+                    self.log.warning("Unexpected content-type response", fields={
+                        'battle_tag': battle_tag, 'status': resp.status,
+                        'content_type': resp.headers.get('content-type')})
+                    embed = discord.Embed(color=0xEE2222, title="Terjadi kesalahan")
+                    embed.description = "Mohon coba lagi dalam beberapa menit.\nUnexpected content-type response from the API."
+                    embed.set_author(name=title, icon_url='https://i.imgur.com/kgrkybF.png')
+                    await ctx.send(content=ctx.message.author.mention, embed=embed)
+                    return None
 
         response = None
         try:
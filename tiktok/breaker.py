@@ -0,0 +1,93 @@
+import collections
+import time
+
+ERROR_CLASSES = ('captcha', 'timeout', 'proxy', 'not_found', 'other')
+# A user that does not exist is a perfectly healthy answer from TikTok
+HEALTHY_CLASSES = ('not_found',)
+
+
+class CircuitBreaker:
+    """Stops requests to TikTok while most of them are failing
+
+    Outcomes are kept for a rolling `window` of seconds. Once at least
+    `min_requests` were made and `failure_rate` of them failed, the breaker opens
+    and refuses requests for an exponentially growing delay. After that a single
+    probe is let through (half-open), its outcome closes or reopens the breaker.
+    """
+
+    def __init__(self, window=300, min_requests=5, failure_rate=0.5, base_delay=60, max_delay=1800,
+                 probe_timeout=120):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_timeout = probe_timeout
+
+        self.outcomes = collections.deque()
+        self.state = 'closed'
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+
+    def trim(self, now):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def allow(self):
+        """Whether a request may be made right now"""
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() >= self.open_until:
+            self.state = 'half_open'
+        # A probe that never reported back should not keep the breaker stuck
+        if self.state == 'half_open' and (not self.probing or
+                                          time.monotonic() - self.probe_started > self.probe_timeout):
+            self.probing = True
+            self.probe_started = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.record(None)
+
+    def failure(self, error_class):
+        self.record(error_class)
+
+    def record(self, error_class):
+        now = time.monotonic()
+        self.outcomes.append((now, error_class))
+        self.trim(now)
+        failed = error_class is not None and error_class not in HEALTHY_CLASSES
+
+        if self.state == 'half_open' and self.probing:
+            self.probing = False
+            if failed:
+                self.open(now)
+            else:
+                # Start over, the failures that tripped the breaker are history now
+                self.state = 'closed'
+                self.trips = 0
+                self.outcomes.clear()
+            return
+
+        if self.state == 'closed' and failed:
+            failures = sum(1 for _, cls in self.outcomes if cls is not None and cls not in HEALTHY_CLASSES)
+            if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.failure_rate:
+                self.open(now)
+
+    def open(self, now):
+        self.state = 'open'
+        self.open_until = now + min(self.max_delay, self.base_delay * 2 ** min(self.trips, 16))
+        self.trips += 1
+
+    def retry_in(self):
+        return max(0.0, self.open_until - time.monotonic()) if self.state == 'open' else 0.0
+
+    def rates(self):
+        """Share of the requests in the window that ended with each error class"""
+        self.trim(time.monotonic())
+        total = len(self.outcomes)
+        counts = collections.Counter(cls for _, cls in self.outcomes if cls is not None)
+        return {cls: counts[cls] / total if total else 0.0 for cls in ERROR_CLASSES}, total
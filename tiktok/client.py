@@ -0,0 +1,141 @@
+import asyncio
+import time
+from urllib.parse import urlencode
+
+from TikTokApi.exceptions import TikTokCaptchaError, TikTokNotFoundError
+from owidlib import runtime
+
+BASE_URL = "https://m.tiktok.com/"
+# Status codes TikTok answers with for users that do not exist or were banned
+NOT_FOUND_CODES = (10202, 10221, 10222, 10223)
+# Status code of the verification (captcha) challenge
+CAPTCHA_CODE = 10000
+
+
+class SignatureRejected(Exception):
+    pass
+
+
+class TikTokUnavailable(Exception):
+    """TikTok answered with an error that is likely to go away, such as rate limiting"""
+    pass
+
+
+def check_status(data):
+    """Raise the matching error for TikTok error answers"""
+    if not isinstance(data, dict):
+        raise TikTokUnavailable(f"Unexpected answer of type {type(data).__name__}")
+    status = data.get('statusCode') or 0
+    # The challenge comes as {"type": "verify", "code": "10000", ...}
+    if data.get('type') == 'verify' or str(CAPTCHA_CODE) in (str(status), str(data.get('code'))):
+        raise TikTokCaptchaError()
+    if status in NOT_FOUND_CODES:
+        raise TikTokNotFoundError()
+    if status:
+        raise TikTokUnavailable(f"TikTok answered with status {status}: {data.get('statusMsg', '')}")
+
+
+class FeedClient:
+    """Fetches TikTok user feeds over the shared aiohttp session
+
+    The browser is only needed to sign request urls: signed urls are cached
+    for `signature_ttl` seconds together with the verifyFp cookie they were
+    signed with and reused by every poll until they expire or TikTok rejects
+    them. Users are resolved to their ids once, so a poll is a single request.
+    """
+
+    def __init__(self, api, log, signature_ttl=1800):
+        self.api = api
+        self.log = log
+        self.signature_ttl = signature_ttl
+        self.users = {}
+        self.signatures = {}
+        self.sign_lock = asyncio.Lock()
+        self.stats = {'requests': 0, 'signed': 0, 'rejected': 0}
+
+    def params(self, **query):
+        params = {
+            'aid': 1988,
+            'app_name': 'tiktok_web',
+            'device_platform': 'web',
+            'cookie_enabled': 'true',
+            'browser_language': 'en-US',
+            'browser_platform': 'Win32',
+            'browser_name': 'Mozilla',
+            'browser_online': 'true',
+            'appId': 1233,
+            'region': 'US',
+            'priority_region': '',
+            'language': 'en',
+        }
+        params.update(query)
+        return urlencode(params)
+
+    def sign(self, url):
+        """Sign a url in the browser, blocking"""
+        verify_fp, did, signature = self.api.browser.sign_url(url=url, custom_verifyFp=self.api.custom_verifyFp)[:3]
+        signed_url = f"{url}&{urlencode({'verifyFp': verify_fp, 'did': did, '_signature': signature})}"
+        headers = {
+            'User-Agent': self.api.browser.userAgent,
+            'Referer': self.api.browser.referrer,
+            'Cookie': f"tt_webid_v2={did}; s_v_web_id={verify_fp}",
+        }
+        return signed_url, headers
+
+    async def get_signed(self, url):
+        signed = self.signatures.get(url)
+        if signed and signed[2] > time.monotonic() and signed[3] == self.api.custom_verifyFp:
+            return signed[0], signed[1]
+
+        async with self.sign_lock:
+            verify_fp = self.api.custom_verifyFp
+            signed_url, headers = await runtime.run_io(self.sign, url)
+            self.stats['signed'] += 1
+            self.signatures[url] = (signed_url, headers, time.monotonic() + self.signature_ttl, verify_fp)
+        return signed_url, headers
+
+    async def get(self, url):
+        """Request a signed api url, signing it again once if TikTok rejects the cached signature"""
+        for attempt in range(2):
+            signed_url, headers = await self.get_signed(url)
+            proxy = self.api.proxy
+            if proxy and '://' not in proxy:
+                proxy = f"http://{proxy}"
+
+            self.stats['requests'] += 1
+            async with runtime.get_session().get(signed_url, headers=headers, proxy=proxy) as r:
+                text = await r.text()
+                try:
+                    if r.status == 403 or not text:
+                        raise SignatureRejected()
+                    return await r.json(content_type=None)
+                except (ValueError, SignatureRejected):
+                    self.stats['rejected'] += 1
+                    self.signatures.pop(url, None)
+                    if attempt:
+                        raise TikTokCaptchaError()
+                    self.log.debug("Signature rejected, signing again")
+
+    async def user_ids(self, username):
+        if username.lower() not in self.users:
+            data = await self.get(f"{BASE_URL}api/user/detail/?{self.params(uniqueId=username)}")
+            check_status(data)
+            if 'userInfo' not in data:
+                raise TikTokUnavailable("User details without userInfo")
+            user = data['userInfo']['user']
+            self.users[username.lower()] = (user['id'], user['secUid'])
+        return self.users[username.lower()]
+
+    async def user_feed(self, username, count):
+        """Latest `count` posts of a user, as returned by TikTokApi's byUsername"""
+        user_id, sec_uid = await self.user_ids(username)
+        data = await self.get(f"{BASE_URL}api/item_list/?"
+                              f"{self.params(count=count, id=user_id, secUid=sec_uid, cursor=0, type=1, sourceType=8)}")
+        try:
+            check_status(data)
+        except TikTokNotFoundError:
+            self.users.pop(username.lower(), None)
+            raise
+        if 'items' not in data:
+            raise TikTokUnavailable("Feed without items")
+        return data['items'][:count]
@@ -0,0 +1,166 @@
+import json
+import math
+import os
+import socket
+import time
+import zlib
+
+from owidlib import SQLiteStore
+
+
+def get_partition(username, partitions):
+    """Stable partition of a TikTok username, identical in every process"""
+    return zlib.crc32(username.lower().encode()) % partitions
+
+
+class LeaseStore(SQLiteStore):
+    """Splits TikTok polling between bot processes sharing a folder
+
+    Subscriptions are partitioned by username hash, every process holds
+    time-limited leases on its fair share of the partitions and only polls
+    TikTok for those. Each process lists the usernames its guilds subscribe to
+    in `wanted`, the owner of a partition polls every wanted username in it and
+    publishes the fetched feeds so the other processes can post them without
+    polling themselves. The cover cache is shared as well, `covers` records which
+    process still holds each cover so none is deleted while another one uses it.
+    """
+
+    def __init__(self, path, partitions, lease_time=900):
+        # Other processes hold the write lock now and then, wait for them rather than failing
+        super().__init__(path, """
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                partition INTEGER PRIMARY KEY,
+                owner TEXT,
+                expires REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS wanted (
+                username TEXT NOT NULL,
+                worker TEXT NOT NULL,
+                heartbeat REAL NOT NULL,
+                PRIMARY KEY (username, worker)
+            );
+            CREATE TABLE IF NOT EXISTS covers (
+                post_id TEXT NOT NULL,
+                worker TEXT NOT NULL,
+                heartbeat REAL NOT NULL,
+                PRIMARY KEY (post_id, worker)
+            );
+            CREATE TABLE IF NOT EXISTS feeds (
+                username TEXT PRIMARY KEY,
+                fetched REAL NOT NULL,
+                posts TEXT NOT NULL
+            );
+        """, timeout=30)
+        self.partitions = partitions
+        self.lease_time = lease_time
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        self.owned = set()
+
+    def partition(self, username):
+        return get_partition(username, self.partitions)
+
+    def owns(self, username):
+        return self.partition(username) in self.owned
+
+    def acquire(self):
+        """Renew our leases and claim or give up partitions until we hold our fair share"""
+        now = time.time()
+        with self.transaction('IMMEDIATE'):
+            self.db.execute("INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)", (self.worker, now))
+            self.db.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.lease_time,))
+            self.db.execute("UPDATE covers SET heartbeat = ? WHERE worker = ?", (now, self.worker))
+            self.db.execute("DELETE FROM covers WHERE heartbeat < ?", (now - self.lease_time,))
+            workers = self.db.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+            fair_share = math.ceil(self.partitions / max(1, workers))
+
+            owned = [partition for partition, in self.db.execute(
+                "SELECT partition FROM leases WHERE owner = ? AND expires > ? AND partition < ? ORDER BY partition",
+                (self.worker, now, self.partitions))]
+
+            # Hand back partitions when another process joined
+            released = owned[fair_share:]
+            owned = owned[:fair_share]
+            self.db.executemany("UPDATE leases SET owner = NULL, expires = 0 WHERE partition = ?",
+                                [(partition,) for partition in released])
+
+            if len(owned) < fair_share:
+                taken = {partition for partition, in self.db.execute(
+                    "SELECT partition FROM leases WHERE owner IS NOT NULL AND owner != ? AND expires > ?",
+                    (self.worker, now))}
+                free = [partition for partition in range(self.partitions)
+                        if partition not in taken and partition not in owned]
+                owned += free[:fair_share - len(owned)]
+
+            self.db.executemany("INSERT OR REPLACE INTO leases (partition, owner, expires) VALUES (?, ?, ?)",
+                                [(partition, self.worker, now + self.lease_time) for partition in owned])
+
+        self.owned = set(owned)
+        return self.owned
+
+    def want(self, usernames, replace=True):
+        """Replace the usernames this process needs feeds for, and forget those of processes that went away
+
+        With `replace` unset the usernames are added to the ones we already want"""
+        now = time.time()
+        with self.transaction():
+            if replace:
+                self.db.execute("DELETE FROM wanted WHERE worker = ?", (self.worker,))
+            self.db.execute("DELETE FROM wanted WHERE heartbeat < ?", (now - self.lease_time,))
+            self.db.executemany("INSERT OR REPLACE INTO wanted (username, worker, heartbeat) VALUES (?, ?, ?)",
+                                [(username.lower(), self.worker, now) for username in usernames])
+
+    def wanted(self):
+        """Usernames any process needs that fall in the partitions we own"""
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT username FROM wanted WHERE heartbeat > ?",
+                                   (time.time() - self.lease_time,)).fetchall()
+        return {username for username, in rows if self.owns(username)}
+
+    def release(self):
+        with self.lock:
+            self.db.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?", (self.worker,))
+            self.db.execute("DELETE FROM workers WHERE id = ?", (self.worker,))
+            self.db.execute("DELETE FROM wanted WHERE worker = ?", (self.worker,))
+        self.owned = set()
+
+    def hold_covers(self, held, dropped):
+        """Record the covers of the posts we started and stopped using, returns the dropped ones no process holds"""
+        now = time.time()
+        with self.transaction():
+            self.db.executemany("INSERT OR REPLACE INTO covers (post_id, worker, heartbeat) VALUES (?, ?, ?)",
+                                [(post_id, self.worker, now) for post_id in held])
+            self.db.executemany("DELETE FROM covers WHERE post_id = ? AND worker = ?",
+                                [(post_id, self.worker) for post_id in dropped])
+            return [post_id for post_id in dropped
+                    if self.db.execute("SELECT 1 FROM covers WHERE post_id = ?", (post_id,)).fetchone() is None]
+
+    def publish(self, username, posts):
+        """Publish the fetched feed of a username, None when the user does not exist"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO feeds (username, fetched, posts) VALUES (?, ?, ?)",
+                            (username.lower(), time.time(), json.dumps(posts)))
+
+    def fetched(self, username):
+        """Unix time the feed of a username was last published, None if it never was"""
+        with self.lock:
+            row = self.db.execute("SELECT fetched FROM feeds WHERE username = ?", (username.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def feed(self, username):
+        """Last feed published for a username by whichever process owns it
+
+        None if the owner recently found the user does not exist, older answers
+        are ignored in case the username was taken again since."""
+        with self.lock:
+            row = self.db.execute("SELECT fetched, posts FROM feeds WHERE username = ?",
+                                  (username.lower(),)).fetchone()
+        if not row:
+            return []
+        posts = json.loads(row[1])
+        if posts is None and time.time() - row[0] > self.lease_time:
+            return []
+        return posts
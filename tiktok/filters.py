@@ -0,0 +1,59 @@
+import functools
+import re
+
+
+def is_empty_term(term):
+    """Blank terms and a bare `music:` would match every post"""
+    term = term.strip()
+    return not term or (term.lower().startswith('music:') and not term[len('music:'):].strip())
+
+
+def compile_terms(terms):
+    """One regex for the description and one for the music of a list of filter terms
+
+    Terms starting with `#` match a hashtag, `music:` terms match part of the song
+    title or artist and any other term matches a whole word of the description.
+    Empty terms are left out."""
+    desc, music = [], []
+    for term in terms:
+        if is_empty_term(term):
+            continue
+        if term.lower().startswith('music:'):
+            music.append(re.escape(term[len('music:'):].strip()))
+        elif term.startswith('#'):
+            desc.append(re.escape(term) + r'(?!\w)')
+        else:
+            desc.append(r'(?<!\w)' + re.escape(term) + r'(?!\w)')
+    return tuple(re.compile('|'.join(patterns), re.IGNORECASE) if patterns else None for patterns in (desc, music))
+
+
+class PostFilter:
+    """Include and exclude terms of a subscription, a post is kept when it matches
+    any include term (or there are none) and no exclude term"""
+
+    def __init__(self, include=(), exclude=()):
+        self.include = compile_terms(include) if include else None
+        self.exclude = compile_terms(exclude) if exclude else None
+        # Only empty terms, same as no terms at all
+        if self.include == (None, None):
+            self.include = None
+        if self.exclude == (None, None):
+            self.exclude = None
+
+    @staticmethod
+    def search(patterns, post):
+        desc, music = patterns
+        if desc and desc.search(post['desc']):
+            return True
+        return bool(music and music.search(f"{post['music']} - {post['music_author'] or ''}"))
+
+    def matches(self, post):
+        if self.include and not self.search(self.include, post):
+            return False
+        return not (self.exclude and self.search(self.exclude, post))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_filter(include, exclude):
+    """The compiled filter of a subscription, `include` and `exclude` are tuples of terms"""
+    return PostFilter(include, exclude)
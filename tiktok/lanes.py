@@ -0,0 +1,70 @@
+import asyncio
+import itertools
+
+
+class Lane:
+    """A work queue with its own workers, so cheap jobs never wait behind expensive ones
+
+    Jobs are coroutine functions run by `concurrency` workers, lowest `priority`
+    first. Jobs that make an upstream request call `throttle()` first, which keeps
+    those requests at least `spacing` seconds apart while jobs that return early
+    run back to back. `submit()` returns a future resolved with the job's result.
+    """
+
+    def __init__(self, name, concurrency=1, spacing=0.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.spacing = spacing
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.workers = []
+        self.done = 0
+        self.next_request = 0.0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        # Nothing will run the queued jobs anymore, don't leave whoever awaits them hanging
+        while not self.queue.empty():
+            _, _, future, _, _ = self.queue.get_nowait()
+            future.cancel()
+            self.queue.task_done()
+
+    def submit(self, job, *args, priority=1):
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        # The counter keeps jobs of the same priority in order and futures out of comparisons
+        self.queue.put_nowait((priority, next(self.counter), future, job, args))
+        return future
+
+    async def worker(self):
+        while True:
+            _, _, future, job, args = await self.queue.get()
+            try:
+                if not future.cancelled():
+                    future.set_result(await job(*args))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.done += 1
+                self.queue.task_done()
+
+    async def throttle(self):
+        """Wait for the next free request slot, `spacing` seconds after the previous one"""
+        now = asyncio.get_event_loop().time()
+        slot = max(now, self.next_request)
+        self.next_request = slot + self.spacing
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pending(self):
+        return self.queue.qsize()
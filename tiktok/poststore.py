@@ -0,0 +1,113 @@
+import json
+import time
+from datetime import datetime
+
+from owidlib import SQLiteStore
+
+SCHEMA_VERSION = 1
+# Functions upgrading a record of version N to version N + 1
+UPGRADES = {}
+
+
+def compact_post(post):
+    """Reduce a raw TikTok post to the fields a Discord post is rendered from"""
+    if 'v' in post:
+        return load_post(post)
+
+    music = post.get('music') or {}
+    return {
+        'v': SCHEMA_VERSION,
+        'id': str(post['id']),
+        'user': post['author']['uniqueId'],
+        'name': post['author']['nickname'],
+        'avatar': post['author']['avatarMedium'],
+        'desc': post.get('desc', ''),
+        'music': music.get('title', ''),
+        'music_author': music.get('authorName'),
+        'created': int(post['createTime']),
+        'cover': post['video']['cover'],
+        'dynamic_cover': post['video']['dynamicCover'],
+    }
+
+
+def load_post(data):
+    """A post record of the current version from a stored record of any version, or from a raw post"""
+    if 'v' not in data:
+        return compact_post(data)
+    while data['v'] < SCHEMA_VERSION:
+        data = UPGRADES[data['v']](data)
+    return data
+
+
+class PostStore(SQLiteStore):
+    """SQLite store of the posts seen by every guild, replaces the `global_cache` config entry
+
+    Posts are kept as compact versioned records, the oldest are evicted once
+    more than the configured cache size are stored.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, """
+            CREATE TABLE IF NOT EXISTS posts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                username TEXT NOT NULL,
+                updated INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS posts_user ON posts (username, updated);
+        """)
+
+    def insert(self, records, updated):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO posts (id, username, updated, version, data) VALUES (?, ?, ?, ?, ?)",
+            [(record['id'], record['user'].lower(), updated, record['v'], json.dumps(record, separators=(',', ':')))
+             for record in records]
+        )
+
+    def add(self, records, size):
+        """Store new post records, returns the ids of the posts evicted to stay within `size`"""
+        with self.transaction():
+            self.insert(records, int(time.time()))
+            evicted = [post_id for post_id, in self.db.execute(
+                "SELECT id FROM posts ORDER BY seq DESC LIMIT -1 OFFSET ?", (max(0, size),))]
+            self.db.executemany("DELETE FROM posts WHERE id = ?", [(post_id,) for post_id in evicted])
+        return evicted
+
+    def by_user(self, username):
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM posts WHERE username = ? ORDER BY seq",
+                                   (username.lower(),)).fetchall()
+        return [load_post(json.loads(data)) for data, in rows]
+
+    def last_updated(self, username):
+        """Unix time at which the newest post of a user was stored, None if there is none"""
+        with self.lock:
+            return self.db.execute("SELECT MAX(updated) FROM posts WHERE username = ?",
+                                   (username.lower(),)).fetchone()[0]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    def clear(self):
+        """Forget every post, returns the ids of the posts that were stored"""
+        with self.transaction():
+            cleared = [post_id for post_id, in self.db.execute("SELECT id FROM posts")]
+            self.db.execute("DELETE FROM posts")
+        return cleared
+
+    def migrate(self, global_cache):
+        """Import the entries of the old `global_cache` config, oldest first, returns how many were imported"""
+        migrated = 0
+        with self.transaction():
+            for entry in global_cache:
+                try:
+                    record = compact_post(entry['post'])
+                    updated = datetime.strptime(entry['last-updated'], '%Y-%m-%d %H:%M:%S.%f').timestamp()
+                except (KeyError, TypeError, ValueError):
+                    continue
+                self.insert([record], int(updated))
+                migrated += 1
+        return migrated
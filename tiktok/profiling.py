@@ -0,0 +1,68 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+CATEGORIES = ('fetch', 'proxy', 'covers', 'config', 'discord')
+
+
+class CycleProfile:
+    """cProfile, tracemalloc and per-category wall time of a polling cycle
+
+    cProfile only sees the event loop thread and counts CPU time, awaited work
+    such as requests and executor jobs is attributed to `CATEGORIES` through
+    `timed()`. Categories run concurrently, their totals may exceed the cycle.
+    """
+
+    def __init__(self):
+        self.timings = {category: [0.0, 0] for category in CATEGORIES}
+        self.profile = cProfile.Profile()
+        self.started = 0.0
+        self.elapsed = 0.0
+        self.peak = 0
+        self.snapshot = None
+        self.was_tracing = False
+
+    async def timed(self, category, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[category][0] += time.perf_counter() - started
+            self.timings[category][1] += 1
+
+    def start(self):
+        self.was_tracing = tracemalloc.is_tracing()
+        if not self.was_tracing:
+            tracemalloc.start(10)
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.elapsed = time.perf_counter() - self.started
+        self.peak = tracemalloc.get_traced_memory()[1]
+        self.snapshot = tracemalloc.take_snapshot()
+        if not self.was_tracing:
+            tracemalloc.stop()
+
+    def report(self, limit=25):
+        out = io.StringIO()
+        out.write(f"Cycle took {self.elapsed:.3f}s, peak traced memory {self.peak / 1024:.0f} KiB\n")
+        out.write("Everything else running on the event loop meanwhile is included\n\n")
+
+        out.write("== Time by category (wall clock) ==\n")
+        for category, (total, count) in self.timings.items():
+            out.write(f"{category:>10}: {total:8.3f}s in {count} call(s)\n")
+
+        for sort, label in (('cumulative', 'cumulative'), ('tottime', 'own')):
+            out.write(f"\n== Hotspots by {label} time (event loop CPU) ==\n")
+            pstats.Stats(self.profile, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+
+        out.write("\n== Largest allocations still alive ==\n")
+        for stat in self.snapshot.statistics('lineno')[:limit]:
+            out.write(f"{stat}\n")
+        return out.getvalue()
@@ -1,9 +1,9 @@
 import asyncio
-import functools
 import io
 import logging
 import platform
 import re
+import threading
 import time
 import traceback
 import os
@@ -18,6 +18,15 @@ from PIL import Image, UnidentifiedImageError
 from TikTokApi import TikTokApi
 from TikTokApi.exceptions import TikTokCaptchaError, TikTokNotFoundError
 from colorhash import ColorHash
+from owidlib import runtime
+
+from .breaker import CircuitBreaker, ERROR_CLASSES
+from .client import FeedClient, TikTokUnavailable
+from .coordination import LeaseStore
+from .filters import get_filter, is_empty_term
+from .lanes import Lane
+from .poststore import PostStore, compact_post, load_post
+from .profiling import CycleProfile
 from redbot.core import commands, Config, checks
 from redbot.core.data_manager import bundled_data_path, cog_data_path
 from requests.exceptions import ConnectionError, ProxyError, ChunkedEncodingError, InvalidURL
@@ -40,35 +49,57 @@ class TikTok(commands.Cog):
         super().__init__(*args, **kwargs)
 
         self.bot = bot
-        self.log = logging.getLogger("tiktok")
-        self.log.setLevel(logging.DEBUG)
+        self.log = runtime.get_logger("tiktok")
         self.proxy = None
         self.api = None
         self.driver = None
+        self.client = None
+        self.profiler = None
         self.background_task = None
         self.proxies = []
         self.proxy = None
+        self.leases = None
+        self.posts = None
+        self.guild_locks = {}
+        self.breaker = CircuitBreaker()
+        self.retry_budget = 0
+        self.budget_exhausted = False
+        self.fast_lane = Lane("cache", concurrency=4)
+        self.slow_lane = Lane("fetch", concurrency=1)
+        self.cache_path = cog_data_path(self) / "caches"
 
         self.config = Config.get_conf(self, identifier=UNIQUE_ID, force_registration=True)
         self.config.register_guild(subscriptions=[], cache=[])
-        self.config.register_global(interval=300, global_cache_size=500, global_cache=[], verifyFp=[])
+        self.config.register_global(interval=300, global_cache_size=500, global_cache=[], verifyFp=[],
+                                    log_level='INFO', shards=1, shared_path='',
+                                    fetch_spacing=1.0, retry_budget=10)
+        runtime.acquire()
         self.main_task = self.bot.loop.create_task(self.initialize())
 
     async def initialize(self):
         await self.bot.wait_until_red_ready()
+        runtime.set_log_level("tiktok", await self.config.log_level())
+        await self.open_post_store()
+
+        shards = await self.config.shards()
+        shared_path = await self.config.shared_path()
+        if shards > 1 and shared_path:
+            # Leases outlive a few polling cycles so a slow cycle does not hand partitions around
+            lease_time = max(60, 3 * await self.config.interval())
+            self.leases = await runtime.run_io(LeaseStore, Path(shared_path) / "leases.db", shards, lease_time)
+            self.cache_path = Path(shared_path) / "caches"
+            self.log.info(f"Sharded mode: {shards} partitions shared through {shared_path}")
 
         if platform.system() == 'Windows':
             self.driver = str(bundled_data_path(self)) + r'\chromedriver_win'
         elif platform.system() == 'Linux':
             self.driver = str(bundled_data_path(self)) + r'/chromedriver'
-
-            import os
-            os.chmod(self.driver, 0o777)
+            await runtime.run_io(os.chmod, self.driver, 0o777)
 
         verifyFp = await self.config.verifyFp()
 
         try:
-            task = self.bot.loop.run_in_executor(None, self.get_tiktok_cookie)
+            task = runtime.run_io(self.get_tiktok_cookie)
             verifyFp = await asyncio.wait_for(task, timeout=30)
             await self.config.verifyFp.set(verifyFp)
         except TimeoutError:
@@ -83,39 +114,131 @@ class TikTok(commands.Cog):
         self.log.info(f"VerifyFp: {verifyFp}")
         self.api = TikTokApi.get_instance(use_test_endpoints=False, custom_verifyFp=verifyFp,
                                           use_selenium=True, executablePath=self.driver,
-                                          proxy=self.proxy, logging_level=logging.DEBUG)
+                                          proxy=self.proxy,
+                                          logging_level=logging.getLevelName(await self.config.log_level()))
+        self.client = FeedClient(self.api, self.log)
 
         self.log.info(f"Proxy: {self.proxy}")
+        self.slow_lane.spacing = await self.config.fetch_spacing()
         self.background_task = self.bot.loop.create_task(self.background_get_new_videos())
 
-    def get_tiktok_by_name(self, username, count):
-        return self.api.byUsername(username, count=count)
+    async def open_post_store(self):
+        self.posts = await runtime.run_io(PostStore, cog_data_path(self) / "posts.db")
 
-    def get_tiktok_dynamic_cover(self, post):
-        # temporarily disable proxy
-        self.log.debug(f"Cover link: {post['video']['dynamicCover']}")
-        image_path = Path(f"{str(cog_data_path(self))}/caches/")
-        image_file = Path(f"{str(image_path)}/{post['id']}.gif")
-        if image_file.is_file():
+        # Posts used to be kept in the config, which is rewritten in full on every save
+        global_cache = await self.config.global_cache()
+        if global_cache:
+            migrated = await runtime.run_io(self.posts.migrate, global_cache)
+            await self.config.global_cache.set([])
+            self.log.info(f"Moved {migrated} of {len(global_cache)} cached post(s) to the post store")
+
+    async def get_tiktok_by_name(self, username, count):
+        # The browser is only used to sign requests, unless this TikTokApi version cannot sign urls for us
+        if hasattr(self.api.browser, 'sign_url'):
+            return await self.client.user_feed(username, count)
+        return await runtime.run_io(self.api.byUsername, username, count=count)
+
+    def get_cover_path(self, post_id, extension):
+        return self.cache_path / f"{post_id}.{extension}"
+
+    async def download(self, url):
+        # Cover links are CDN links, they never need the TikTok proxy
+        hdr = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'}
+        async with runtime.get_session().get(url, headers=hdr) as r:
+            r.raise_for_status()
+            return await r.read()
+
+    async def get_tiktok_dynamic_cover(self, post):
+        image_file = self.get_cover_path(post['id'], 'gif')
+        if await runtime.run_io(image_file.is_file):
             self.log.debug(f"Using cached cover: {str(image_file)}")
-            return discord.File(str(image_file))
+            return image_file
 
-        temp = self.api.proxy
-        self.api.proxy = None
-        image_data = self.api.getBytes(url=post['video']['dynamicCover'], proxy=None)
-        self.api.proxy = temp
+        self.log.debug(f"Cover link: {post['dynamic_cover']}")
+        image_data = await self.download(post['dynamic_cover'])
+        await runtime.run_cpu(self.transcode_cover, image_data, image_file)
+        return image_file
 
+    def transcode_cover(self, image_data, image_file):
         im = Image.open(io.BytesIO(image_data))
         im.info.pop('background', None)
-        image_path.mkdir(parents=True, exist_ok=True)
-
-        with io.BytesIO() as image_binary:
-            self.log.debug(f"Saving to {str(image_file)}")
-            im.save(image_binary, 'gif', save_all=True)
-            im.save(str(image_file), 'gif', save_all=True)
-            image_binary.seek(0)
-            file = discord.File(fp=image_binary, filename=f"{post['id']}.gif")
-            return file
+        image_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write under a temporary name first, other processes may read the shared cache at any time
+        self.log.debug(f"Saving to {str(image_file)}")
+        temp_file = self.get_temp_path(image_file)
+        im.save(str(temp_file), 'gif', save_all=True)
+        os.replace(str(temp_file), str(image_file))
+
+    async def get_tiktok_static_cover(self, post):
+        image_file = self.get_cover_path(post['id'], 'jpg')
+        if await runtime.run_io(image_file.is_file):
+            return image_file
+
+        image_data = await self.download(post['cover'])
+        await runtime.run_io(self.save_file, image_file, image_data)
+        return image_file
+
+    @staticmethod
+    def get_temp_path(path):
+        # Unique per thread, the same cover may be fetched by a replay and a prefetch at once
+        return path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+    def save_file(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.get_temp_path(path)
+        temp_file.write_bytes(data)
+        os.replace(str(temp_file), str(path))
+
+    async def prefetch_covers(self, posts):
+        """Download the static and dynamic covers of every post at once
+
+        Cover links are signed and expire, a local copy keeps replayed posts from showing broken images"""
+        jobs = []
+        for post in posts:
+            jobs.append(asyncio.wait_for(self.get_tiktok_static_cover(post), timeout=30))
+            jobs.append(asyncio.wait_for(self.get_tiktok_dynamic_cover(post), timeout=30))
+
+        for result in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, (TimeoutError, timeout)):
+                self.log.warning("Cover download took too long")
+            elif isinstance(result, UnidentifiedImageError):
+                self.log.warning("Could not read dynamic cover")
+            elif isinstance(result, Exception):
+                self.log.warning(f"Unable to download cover: [{type(result).__name__}] {str(result)}")
+
+    def get_cover_file(self, post):
+        """The best local cover of a post as an attachment, the animated one if possible"""
+        for extension in ('gif', 'jpg'):
+            image_file = self.get_cover_path(post['id'], extension)
+            if image_file.is_file():
+                return discord.File(str(image_file), filename=f"{post['id']}.{extension}")
+        return None
+
+    def delete_file(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.log.error('Failed to delete %s. Reason: %s' % (path, e))
+
+    def delete_covers(self, post_id):
+        for extension in ('gif', 'jpg'):
+            cached_cover = self.get_cover_path(post_id, extension)
+            self.log.debug(f"Deleting {str(cached_cover)} from disk..")
+            self.delete_file(cached_cover)
+
+    def clear_folder(self, folder):
+        if not os.path.isdir(folder):
+            return
+        for filename in os.listdir(folder):
+            file_path = os.path.join(folder, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+            except OSError as e:
+                self.log.error('Failed to delete %s. Reason: %s' % (file_path, e))
 
     def get_tiktok_cookie(self):
         from selenium import webdriver
@@ -179,15 +302,15 @@ class TikTok(commands.Cog):
             try:
                 # https://github.com/aio-libs/aiohttp/issues/3203
                 session_timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5)
-                async with aiohttp.ClientSession(timeout=session_timeout) as session:
-                    async with session.get(url, headers=hdr, allow_redirects=False, timeout=1) as r:
-                        res = await r.text()
-
-                        for lines in res.split('\n'):
-                            proxy = ''.join(lines)
-                            if len(proxy) == 0:
-                                continue
-                            proxies_list.append(proxy)
+                async with runtime.get_session().get(url, headers=hdr, allow_redirects=False,
+                                                     timeout=session_timeout) as r:
+                    res = await r.text()
+
+                    for lines in res.split('\n'):
+                        proxy = ''.join(lines)
+                        if len(proxy) == 0:
+                            continue
+                        proxies_list.append(proxy)
             except TimeoutError as e:
                 self.log.error(f"Unable to get database: [{repr(e)}] {str(e)}")
                 return False
@@ -217,136 +340,290 @@ class TikTok(commands.Cog):
         return True
 
     async def get_new_videos(self):
+        self.retry_budget = await self.timed('config', self.config.retry_budget())
+        self.budget_exhausted = False
+        if self.breaker.state != 'closed':
+            self.log.info(f"Circuit {self.breaker.state}, retrying TikTok in {int(self.breaker.retry_in())}s")
+
+        active = []
         for guild in self.bot.guilds:
-            subs = await self.config.guild(guild).subscriptions()
-            cache = await self.config.guild(guild).cache()
-            interval = await self.config.interval()
+            subs = await self.timed('config', self.config.guild(guild).subscriptions())
 
-            for i, sub in enumerate(subs):
+            for sub in subs:
                 self.log.debug(f"Found {sub['id']} from channel #{sub['channel']['name']} in {guild.name}")
-                global_cache = await self.config.global_cache()
                 channel = self.bot.get_channel(int(sub["channel"]["id"]))
-                updateSub = True
-                posts = None
 
                 if not channel:
                     self.log.warning(f"Guild channel not found: {sub['channel']['name']}")
                     self.log.info(f"Deleting {sub['id']} from {sub['channel']['name']}")
-                    subs[:] = [_sub for _sub in subs if
-                               _sub['id'] != sub['id'] and _sub['channel']['id'] != sub['channel']['id']]
-                    await self.config.guild(guild).subscriptions.set(subs)
+                    async with self.config.guild(guild).subscriptions() as _subs:
+                        _subs[:] = [_sub for _sub in _subs if
+                                    _sub['id'] != sub['id'] or _sub['channel']['id'] != sub['channel']['id']]
                     continue
+                active.append((sub, guild))
+
+        shared = set()
+        if self.leases:
+            # Other processes may own the partitions of our users, tell them which ones we need
+            local = {sub['id'].lower() for sub, _ in active}
+            await runtime.run_io(self.leases.want, local)
+            owned = await runtime.run_io(self.leases.acquire)
+            self.log.debug(f"Owning partitions {sorted(owned)} of {self.leases.partitions}")
+            shared = await runtime.run_io(self.leases.wanted) - local
+
+        jobs = []
+        users = {}
+        for sub, guild in active:
+            # Cached posts only need Discord, they should never wait behind TikTok requests
+            jobs.append(self.fast_lane.submit(self.replay_cached_videos, sub, guild))
+            users.setdefault(sub['id'].lower(), []).append((sub, guild))
+
+        # One fetch per user, posted to every subscription of it in this cycle
+        for username, subs in users.items():
+            jobs.append(self.slow_lane.submit(self.update_user, username, subs))
+
+        for username in shared:
+            jobs.append(self.slow_lane.submit(self.update_shared, username))
+
+        for result in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.log.error(f"[{type(result).__name__}] {str(result)}")
+
+    async def replay_cached_videos(self, sub, guild):
+        """Post videos that are already in the global cache but not yet in the guild"""
+        cache = await self.timed('config', self.config.guild(guild).cache())
+        stored = await self.timed('config', runtime.run_io(self.posts.by_user, sub['id']))
+        posts = [post for post in stored if post['id'] not in cache]
+
+        # Another process polls this user, post whatever it published
+        if self.leases and not self.leases.owns(sub['id']):
+            feed = await runtime.run_io(self.leases.feed, sub['id'])
+            if feed is None:
+                self.log.warning(f"TikTok channel not found by the process polling it: {sub['id']}")
+                await self.remove_missing(sub, guild)
+                return
+            posts += [load_post(post) for post in feed]
+
+        posts = self.filter_posts(sub, posts)
+        if posts:
+            self.log.debug(f"Retrieved {len(posts)} cached post(s) of {sub['id']}")
+            # Covers of published feeds are fetched here, once we know the posts pass our filters
+            await self.timed('covers', self.prefetch_covers([post for post in posts if post['id'] not in cache]))
+            await self.post_videos(posts, sub['channel'], guild)
+
+    def filter_posts(self, sub, posts):
+        """Drop the posts rejected by the filters of a subscription, before any cover or Discord work"""
+        if not sub.get('include') and not sub.get('exclude'):
+            return posts
+        post_filter = get_filter(tuple(sub.get('include', [])), tuple(sub.get('exclude', [])))
+        kept = [post for post in posts if post_filter.matches(post)]
+        if len(kept) < len(posts):
+            self.log.debug(f"Filtered out {len(posts) - len(kept)} post(s) of {sub['id']}")
+        return kept
+
+    async def timed(self, category, awaitable):
+        """Await `awaitable`, counting its time towards `category` while `[p]tiktok profile` runs"""
+        if self.profiler is None:
+            return await awaitable
+        return await self.profiler.timed(category, awaitable)
+
+    def use_retry(self):
+        """Take one retry from this cycle's budget, False once it is spent"""
+        if self.retry_budget <= 0:
+            if not self.budget_exhausted:
+                self.log.warning("Retry budget of this cycle is spent, giving up until the next one")
+                self.budget_exhausted = True
+            return False
+        self.retry_budget -= 1
+        return True
 
-                # post cached videos
-                for post in global_cache:
-                    if post['post']['author']['uniqueId'].lower() == sub['id'].lower():
-                        lastUpdate = datetime.strptime(post['last-updated'], '%Y-%m-%d %H:%M:%S.%f')
-                        updateSub = True if (datetime.now() - lastUpdate) > timedelta(seconds=interval) else False
+    async def fetch_feed(self, username):
+        """Fetch the latest videos of a TikTok user as compact records, retrying within the cycle's budget
 
-                        if post['id'] not in cache:
-                            self.log.debug(f"Retrieved cached post {post['id']}")
-                            await self.post_videos([post['post']], sub['channel'], guild)
+        Returns None when giving up and raises TikTokNotFoundError for users that do not exist.
+        In sharded mode the feed is published for the other processes"""
+        posts = None
+        retry_count = 3
+        while True:
+            if not self.breaker.allow():
+                self.log.debug(f"Circuit open, skipping {username} for {int(self.breaker.retry_in())}s")
+                return
 
-                if not updateSub:
-                    self.log.debug(f"Skipping update feed for {sub['id']}")
+            # Only requests that actually reach TikTok are spaced out, skipped subscriptions are not
+            await self.slow_lane.throttle()
+            current_proxy = self.api.proxy
+            try:
+                self.log.debug(f"Fetching data {username} from tiktok.com.. [{current_proxy}]")
+                posts = await asyncio.wait_for(self.timed('fetch', self.get_tiktok_by_name(username, 3)), timeout=30)
+            except TimeoutError:
+                self.log.warning(f"Takes too long!")
+                self.breaker.failure('timeout')
+                if not self.use_retry():
+                    return
+                if self.api.proxy != current_proxy:
+                    self.log.info(f"Detected new proxy {self.api.proxy}")
                     continue
 
-                retry_count = 3
-                while True:
-                    current_proxy = self.api.proxy
-                    try:
-                        self.log.debug(f"Fetching data {sub['id']} from tiktok.com.. [{current_proxy}]")
-                        task = functools.partial(self.get_tiktok_by_name, sub["id"], 3)
-                        task = self.bot.loop.run_in_executor(None, task)
-                        posts = await asyncio.wait_for(task, timeout=30)
-                    except TimeoutError:
-                        self.log.warning(f"Takes too long!")
-                        if self.api.proxy != current_proxy:
-                            self.log.info(f"Detected new proxy {self.api.proxy}")
-                            continue
+                if retry_count < 1:
+                    self.log.warning(f"Reached maximum number of timeout retry attempts!")
+                    await self.timed('proxy', self.get_new_proxy(True))
+                    continue
+                else:
+                    self.log.warning(f"Retrying.. {retry_count}")
+                    retry_count -= 1
+                    continue
+            except TikTokCaptchaError:
+                self.log.warning(f"Captcha error, retrying..")
+                self.breaker.failure('captcha')
+                if not self.use_retry():
+                    return
+                if self.api.proxy != current_proxy:
+                    self.log.info(f"Detected new proxy {self.api.proxy}")
+                    continue
 
-                        if retry_count < 1:
-                            self.log.warning(f"Reached maximum number of timeout retry attempts!")
-                            await self.get_new_proxy(True)
-                            continue
-                        else:
-                            self.log.warning(f"Retrying.. {retry_count}")
-                            retry_count -= 1
-                            continue
-                    except TikTokCaptchaError:
-                        self.log.warning(f"Captcha error, retrying..")
-                        if self.api.proxy != current_proxy:
-                            self.log.info(f"Detected new proxy {self.api.proxy}")
-                            continue
+                await self.timed('proxy', self.get_new_proxy(True))
+                continue
+            except (ConnectionError, ProxyError, ChunkedEncodingError, InvalidURL, aiohttp.ClientError,
+                    TikTokUnavailable) as e:
+                self.log.warning(f"Connection error, retrying: {str(e)}")
+                self.breaker.failure('proxy')
+                if not self.use_retry():
+                    return
+                if self.api.proxy != current_proxy:
+                    self.log.info(f"Detected new proxy {self.api.proxy}")
+                    continue
 
-                        await self.get_new_proxy(True)
-                        continue
-                    except (ConnectionError, ProxyError, ChunkedEncodingError, InvalidURL) as e:
-                        self.log.warning(f"Connection error, retrying: {str(e)}")
-                        if self.api.proxy != current_proxy:
-                            self.log.info(f"Detected new proxy {self.api.proxy}")
-                            continue
+                await self.timed('proxy', self.get_new_proxy(True))
+                continue
+            except TikTokNotFoundError:
+                self.breaker.failure('not_found')
+                if self.leases:
+                    # Let the processes subscribed to this user remove it as well
+                    await runtime.run_io(self.leases.publish, username, None)
+                raise
+            except InvalidSessionIdException:
+                self.log.warning(f"Web browser crashed, setting up new one..")
+                self.breaker.failure('other')
+                from selenium import webdriver
+
+                options = webdriver.ChromeOptions()
+                options.add_argument('--no-sandbox')
+                options.add_argument('--window-size=1420,1080')
+                options.add_argument('--headless')
+                options.add_argument('--disable-gpu')
+                options.add_argument("log-level=2")
 
-                        await self.get_new_proxy(True)
-                        continue
-                    except TikTokNotFoundError:
-                        self.log.warning(f"TikTok channel not found: {sub['id']}")
-                        color = int(hex(int(ColorHash(sub["id"]).hex.replace("#", ""), 16)), 0)
-                        channels = f'<#{channel.id}>' if channel else 'all channels'
-                        embed = discord.Embed(color=color)
-                        embed.description = f'TikTok user ' \
-                                            f'[{sub["id"]}](https://www.tiktok.com/@{sub["id"]}) ' \
-                                            f'could not be found\nand has been removed from {channels}'
-
-                        subs[:] = [_sub for _sub in subs if _sub['id'] != sub['id']]
-                        await self.config.guild(guild).subscriptions.set(subs)
-                        await self.bot.get_channel(int(sub["channel"]["id"])).send(embed=embed)
-                        break
-                    except InvalidSessionIdException:
-                        self.log.warning(f"Web browser crashed, setting up new one..")
-                        from selenium import webdriver
-
-                        options = webdriver.ChromeOptions()
-                        options.add_argument('--no-sandbox')
-                        options.add_argument('--window-size=1420,1080')
-                        options.add_argument('--headless')
-                        options.add_argument('--disable-gpu')
-                        options.add_argument("log-level=2")
-
-                        try:
-                            self.api.browser.browser = webdriver.Chrome(
-                                executable_path=self.api.browser.executablePath, chrome_options=options
-                            )
-                        except Exception as e:
-                            self.log.error(f"Error in setting up new browser: {str(e)}")
-                            raise e
-
-                        # Page avoidance
-                        self.api.browser.setup_browser()
-                        self.log.info("New browser setup!")
-                        continue
-                    except Exception as e:
-                        self.log.error(f"[{type(e).__name__}] {str(e)}")
-                        traceback.print_exc()
-                    else:
-                        # print(f"Response: {posts}")
-                        self.log.debug("Response pass reached..")
-                        break
-
-                if posts is None or len(posts) == 0:
-                    self.log.warning("Empty posts for tiktok: " + sub["id"])
-                    continue
+                try:
+                    self.api.browser.browser = webdriver.Chrome(
+                        executable_path=self.api.browser.executablePath, chrome_options=options
+                    )
+                except Exception as e:
+                    self.log.error(f"Error in setting up new browser: {str(e)}")
+                    raise e
+
+                # Page avoidance
+                self.api.browser.setup_browser()
+                self.log.info("New browser setup!")
+                if not self.use_retry():
+                    return
+                continue
+            except Exception as e:
+                self.log.error(f"[{type(e).__name__}] {str(e)}")
+                traceback.print_exc()
+                self.breaker.failure('other')
+                return
+            else:
+                # print(f"Response: {posts}")
+                self.log.debug("Response pass reached..")
+                self.breaker.success()
+                break
+
+        if posts is None or len(posts) == 0:
+            self.log.warning("Empty posts for tiktok: " + username)
+            return None
+
+        posts = [compact_post(post) for post in posts]
+        if self.leases:
+            await runtime.run_io(self.leases.publish, username, posts)
+        return posts
+
+    async def update_shared(self, username):
+        """Fetch a user in our partitions that only other processes subscribe to, and publish it for them"""
+        interval = await self.timed('config', self.config.interval())
+        fetched = await runtime.run_io(self.leases.fetched, username)
+        if fetched is not None and time.time() - fetched <= interval:
+            return
+
+        # The subscribed processes fetch the covers of the posts that pass their own filters
+        try:
+            await self.fetch_feed(username)
+        except TikTokNotFoundError:
+            self.log.warning(f"TikTok channel not found: {username}, telling the processes that want it")
+
+    async def update_sub(self, sub, guild, force=False):
+        """Fetch the latest videos of a subscription from TikTok and post the new ones"""
+        await self.update_user(sub['id'], [(sub, guild)], force)
+
+    async def update_user(self, username, subs, force=False):
+        """Fetch the latest videos of a TikTok user and post the new ones to each of its `(sub, guild)` subscriptions
+
+        Users fetched less than an interval ago are skipped unless `force` is set"""
+        if self.leases and not self.leases.owns(username):
+            return
+
+        interval = await self.timed('config', self.config.interval())
+        last_updated = await self.timed('config', runtime.run_io(self.posts.last_updated, username))
+        if not force and last_updated is not None and time.time() - last_updated <= interval:
+            self.log.debug(f"Skipping update feed for {username}")
+            return
+
+        try:
+            posts = await self.fetch_feed(username)
+        except TikTokNotFoundError:
+            self.log.warning(f"TikTok channel not found: {username}")
+            for sub, guild in subs:
+                await self.remove_missing(sub, guild)
+            return
+
+        if not posts:
+            return
+        for sub, guild in subs:
+            await self.post_feed(sub, guild, posts)
+
+    async def remove_missing(self, sub, guild):
+        """Remove the subscription of a TikTok user that does not exist, telling its channel"""
+        channel = self.bot.get_channel(int(sub["channel"]["id"]))
+        color = int(hex(int(ColorHash(sub["id"]).hex.replace("#", ""), 16)), 0)
+        channels = f'<#{channel.id}>' if channel else 'all channels'
+        embed = discord.Embed(color=color)
+        embed.description = f'TikTok user ' \
+                            f'[{sub["id"]}](https://www.tiktok.com/@{sub["id"]}) ' \
+                            f'could not be found\nand has been removed from {channels}'
 
-                self.log.debug(f"Retrieved {len([post for post in posts if not post['id'] in cache])} new video posts "
-                               f"from {sub['id']} for {sub['channel']['name']} ({sub['channel']['id']})")
+        async with self.config.guild(guild).subscriptions() as subs:
+            subs[:] = [_sub for _sub in subs if _sub['id'] != sub['id']]
+        if channel:
+            await channel.send(embed=embed)
 
-                await self.post_videos(posts, sub['channel'], guild)
+    async def post_feed(self, sub, guild, posts):
+        """Post the fetched videos of a subscription that its guild has not seen yet"""
+        cache = await self.timed('config', self.config.guild(guild).cache())
+        self.log.debug(f"Retrieved {len([post for post in posts if not post['id'] in cache])} new video posts "
+                       f"from {sub['id']} for {sub['channel']['name']} ({sub['channel']['id']})")
+
+        posts = self.filter_posts(sub, posts)
+        await self.timed('covers', self.prefetch_covers([post for post in posts if post['id'] not in cache]))
+
+        await self.post_videos(posts, sub['channel'], guild)
 
     async def post_videos(self, posts, channel, guild):
-        cache = await self.config.guild(guild).cache()
-        global_cache = await self.config.global_cache()
-        global_cache_size = await self.config.global_cache_size()
-        cover_file = None
+        # Both lanes may post to the same guild at once, never let them post a video twice
+        async with self.guild_locks.setdefault(guild.id, asyncio.Lock()):
+            await self._post_videos(posts, channel, guild)
+
+    async def _post_videos(self, posts, channel, guild):
+        cache = await self.timed('config', self.config.guild(guild).cache())
+        new_posts = []
         for post in posts:
             if post["id"] in cache:
                 self.log.info("Skipping post: " + post["id"])
@@ -354,78 +631,66 @@ class TikTok(commands.Cog):
 
             self.log.info(post)
             self.log.info("DEBUG PASS 1")
-            user_name = post['author']['nickname']
+            user_name = post['name']
             self.log.info("DEBUG PASS 1.1")
-            user_color = int(hex(int(ColorHash(post['author']['uniqueId']).hex.replace("#", ""), 16)), 0)
+            user_color = int(hex(int(ColorHash(post['user']).hex.replace("#", ""), 16)), 0)
             self.log.info("DEBUG PASS 1.2")
-            user_link = f"https://www.tiktok.com/@{post['author']['uniqueId']}/video/{post['id']}"
+            user_link = f"https://www.tiktok.com/@{post['user']}/video/{post['id']}"
             self.log.info("DEBUG PASS 1.3")
             user_video = f"[Click to see full video!]" \
-                         f"(https://www.tiktok.com/@{post['author']['uniqueId']}/video/{post['id']})"
+                         f"(https://www.tiktok.com/@{post['user']}/video/{post['id']})"
             self.log.info("DEBUG PASS 1.4")
-            user_music = f"♫ {post['music']['title']} - {post['music']['authorName']}" \
-                if 'authorName' in post['music'] else f"♫ {post['music']['title']}"
+            user_music = f"♫ {post['music']} - {post['music_author']}" \
+                if post['music_author'] else f"♫ {post['music']}"
             self.log.info("DEBUG PASS 1.5")
-            user_avatar = post['author']['avatarMedium']
+            user_avatar = post['avatar']
             self.log.info("DEBUG PASS 1.6")
             user_content = re.sub(r'#(\w+)', r'[#\1](https://www.tiktok.com/tag/\1)', f"{post['desc']}")
 
             self.log.info("DEBUG PASS 2")
             # Send embed and post in channel
             embed = discord.Embed(color=user_color, url=user_link)
-            embed.timestamp = datetime.utcfromtimestamp(post['createTime'])
+            embed.timestamp = datetime.utcfromtimestamp(post['created'])
             embed.description = user_content
             embed.add_field(name=user_music, value=user_video, inline=False)
             embed.set_author(name=user_name, url=user_link, icon_url=user_avatar)
             embed.set_thumbnail(url='https://i.imgur.com/ivShgrg.png')
 
-            try:
-                self.log.debug("Converting webp thumbnail to GIF..")
-                task = functools.partial(self.get_tiktok_dynamic_cover, post)
-                task = self.bot.loop.run_in_executor(None, task)
-                cover_file = await asyncio.wait_for(task, timeout=30)
-                embed.set_image(url=f"attachment://{post['id']}.gif")
-            except (TimeoutError, timeout):
-                self.log.warning("GIF processing too long, reverting to static cover..")
-                self.log.warning(f"Static cover link: {post['video']['cover']}")
-                embed.set_image(url=post['video']['cover'])
-            except UnidentifiedImageError:
-                self.log.warning("Could not read dynamic cover, reverting to static cover..")
-                self.log.warning(f"Static cover link: {post['video']['cover']}")
-                embed.set_image(url=post['video']['cover'])
-            finally:
-                try:
-                    self.log.debug(f"Posting {post['id']} to the channel #{channel['name']} ({channel['id']})")
-                    await self.bot.get_channel(channel['id']).send(embed=embed, file=cover_file)
-                    cache.append(post["id"])
-                    new_post = {'id': post['id'], 'last-updated': str(datetime.now()), 'post': post}
-                    if new_post not in global_cache:
-                        global_cache.append(new_post)
-                except discord.errors.HTTPException as e:
-                    self.log.error(f"Unable to post: {str(e)}")
-                    continue
-                    pass
-
-        # remove cache if > global_cache_size
-        if len(global_cache) > int(global_cache_size):
-            self.log.debug("Maximum number of cache size reached!")
-            cache_to_delete = next(iter(global_cache))
+            cover_file = await runtime.run_io(self.get_cover_file, post)
+            if cover_file is None:
+                # Posts cached before covers were prefetched
+                await self.timed('covers', self.prefetch_covers([post]))
+                cover_file = await runtime.run_io(self.get_cover_file, post)
 
-            self.log.debug(f"Deleting {cache_to_delete['id']} from global cache..")
-            global_cache[:] = [post for post in global_cache if post.get('id') != cache_to_delete.get('id')]
+            if cover_file is not None:
+                embed.set_image(url=f"attachment://{cover_file.filename}")
+            else:
+                self.log.warning(f"No local cover, using static cover link: {post['cover']}")
+                embed.set_image(url=post['cover'])
 
-            cached_cover = Path(f"{str(cog_data_path(self))}/caches/{cache_to_delete.get('id')}.gif")
-            if cached_cover.exists():
-                self.log.debug(f"Deleting {str(cached_cover)} from disk..")
-                cached_cover.unlink()
+            try:
+                self.log.debug(f"Posting {post['id']} to the channel #{channel['name']} ({channel['id']})")
+                await self.timed('discord', self.bot.get_channel(channel['id']).send(embed=embed, file=cover_file))
+                cache.append(post["id"])
+                new_posts.append(post)
+            except discord.errors.HTTPException as e:
+                self.log.error(f"Unable to post: {str(e)}")
+                continue
 
         self.log.info("DEBUG PASS 3")
         # Add id to published cache
-        await self.config.guild(guild).cache.set(cache)
+        await self.timed('config', self.config.guild(guild).cache.set(cache))
 
         self.log.info("DEBUG PASS 4")
-        # Add post to global cache
-        await self.config.global_cache.set(global_cache)
+        # Add posts to the global cache, the oldest ones beyond global_cache_size are evicted
+        global_cache_size = await self.timed('config', self.config.global_cache_size())
+        evicted = await self.timed('config', runtime.run_io(self.posts.add, new_posts, int(global_cache_size)))
+        if self.leases:
+            # The cover cache is shared, other processes may still be using the covers of the posts we evicted
+            evicted = await runtime.run_io(self.leases.hold_covers, [post['id'] for post in new_posts], evicted)
+        for post_id in evicted:
+            self.log.debug(f"Deleting {post_id} from global cache..")
+            await runtime.run_io(self.delete_covers, post_id)
 
         self.log.info("DEBUG PASS 5")
 
@@ -441,7 +706,16 @@ class TikTok(commands.Cog):
     def cog_unload(self):
         self.log.debug("Shutting down TikTok service..")
         self.main_task.cancel()
-        self.background_task.cancel()
+        if self.background_task:
+            self.background_task.cancel()
+        self.fast_lane.stop()
+        self.slow_lane.stop()
+        if self.leases:
+            self.leases.release()
+            self.leases.close()
+        if self.posts:
+            self.posts.close()
+        runtime.release()
 
     @commands.group()
     async def tiktok(self: commands.Cog, ctx: commands.Context) -> None:
@@ -503,6 +777,15 @@ class TikTok(commands.Cog):
                             f'added to <#{channelDiscord.id}>'
         await ctx.send(embed=embed)
 
+        # Show recent videos right away instead of after the next polling cycle
+        if self.leases:
+            # The process owning this user starts polling it at its next cycle rather than after ours
+            await runtime.run_io(self.leases.want, [tiktokId], False)
+        if self.posts:
+            self.fast_lane.submit(self.replay_cached_videos, newSub, ctx.guild, priority=0)
+        if self.api:
+            self.slow_lane.submit(self.update_sub, newSub, ctx.guild, priority=0)
+
     @tiktok.command()
     @commands.guild_only()
     @checks.admin_or_permissions(manage_guild=True)
@@ -572,16 +855,13 @@ class TikTok(commands.Cog):
     @checks.is_owner()
     async def cache(self, ctx):
         """Clear global cache database"""
-        folder = Path(f"{str(cog_data_path(self))}/caches/")
-        for filename in os.listdir(folder):
-            file_path = os.path.join(folder, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-            except OSError as e:
-                self.log.error('Failed to delete %s. Reason: %s' % (file_path, e))
-
-        await self.config.global_cache.set([])
+        cleared = await runtime.run_io(self.posts.clear)
+        if self.leases:
+            # Only delete the covers no other process sharing the cache still holds
+            for post_id in await runtime.run_io(self.leases.hold_covers, [], cleared):
+                await runtime.run_io(self.delete_covers, post_id)
+        else:
+            await runtime.run_io(self.clear_folder, self.cache_path)
         await ctx.send("Posts database cleared!")
 
     @tiktok.command()
@@ -591,6 +871,132 @@ class TikTok(commands.Cog):
         async with ctx.typing():
             await self.get_new_videos()
 
+    @tiktok.command()
+    @checks.is_owner()
+    async def profile(self, ctx: commands.Context, tiktokId=None):
+        """Profile one polling cycle and attach the report
+
+        If a TikTok user subscribed in this server is given, only that subscription is fetched and posted"""
+        if self.profiler is not None:
+            await ctx.send("A profile is already running")
+            return
+
+        sub = None
+        if tiktokId:
+            subs = await self.config.guild(ctx.guild).subscriptions() if ctx.guild else []
+            sub = next((sub for sub in subs if sub['id'] == tiktokId), None)
+            if sub is None:
+                await ctx.send("Subscription not found")
+                return
+
+        profiler = CycleProfile()
+        self.profiler = profiler
+        profiler.start()
+        try:
+            async with ctx.typing():
+                if sub:
+                    await self.replay_cached_videos(sub, ctx.guild)
+                    await self.update_sub(sub, ctx.guild, force=True)
+                else:
+                    await self.get_new_videos()
+        finally:
+            profiler.stop()
+            self.profiler = None
+
+        embed = discord.Embed(color=0xEE2222, title=f"TikTok profile of {tiktokId or 'a polling cycle'}")
+        embed.description = f"Took {profiler.elapsed:.2f}s, peak traced memory {profiler.peak / 1024:.0f} KiB"
+        for category, (total, count) in profiler.timings.items():
+            embed.add_field(name=category.capitalize(), value=f"{total:.2f}s in {count} call(s)")
+        report = await runtime.run_cpu(profiler.report)
+        await ctx.send(embed=embed, file=discord.File(io.BytesIO(report.encode()), filename="tiktok-profile.txt"))
+
+    @tiktok.command()
+    @checks.is_owner()
+    async def status(self, ctx: commands.Context):
+        """Show the health of the TikTok poller"""
+        rates, total = self.breaker.rates()
+        embed = discord.Embed(color=0xEE2222, title='TikTok status')
+        state = self.breaker.state
+        if state == 'open':
+            state += f" (retrying in {int(self.breaker.retry_in())}s)"
+        embed.add_field(name='Circuit', value=state)
+        embed.add_field(name='Retry budget left', value=str(self.retry_budget))
+        embed.add_field(name='Queued', value=f"{self.fast_lane.pending()} cached, {self.slow_lane.pending()} fetches")
+        if self.posts:
+            embed.add_field(name='Cached posts', value=str(await runtime.run_io(self.posts.count)))
+        embed.add_field(name=f'Errors ({total} requests in {self.breaker.window}s)',
+                        value="\n".join(f"{cls}: {rates[cls]:.0%}" for cls in ERROR_CLASSES), inline=False)
+        if self.client:
+            embed.add_field(name='Feed client', value=f"{self.client.stats['requests']} requests, "
+                                                      f"{self.client.stats['signed']} signatures, "
+                                                      f"{self.client.stats['rejected']} rejected")
+        if self.leases:
+            embed.add_field(name='Partitions', value=f"{sorted(self.leases.owned)} of {self.leases.partitions}",
+                            inline=False)
+        await ctx.send(embed=embed)
+
+    @set.command()
+    @checks.is_owner()
+    async def budget(self, ctx: commands.Context, retries: int):
+        """Set how many retries a polling cycle may spend on failing requests"""
+        await self.config.retry_budget.set(max(0, retries))
+        await ctx.send(f"Retry budget set to {max(0, retries)} per cycle")
+
+    @tiktok.group(name="filter")
+    @commands.guild_only()
+    @checks.admin_or_permissions(manage_guild=True)
+    async def sub_filter(self, ctx: commands.Context) -> None:
+        """
+        Only post the videos of a subscription matching some terms
+
+        `#tag` matches a hashtag, `music:text` matches the song title or artist
+        and any other term matches a whole word of the description
+        """
+        pass
+
+    @sub_filter.command()
+    async def include(self, ctx: commands.Context, tiktokId, *terms):
+        """Only post videos matching any of the terms, no terms removes the filter"""
+        await self._set_filter(ctx, tiktokId, 'include', terms)
+
+    @sub_filter.command()
+    async def exclude(self, ctx: commands.Context, tiktokId, *terms):
+        """Never post videos matching any of the terms, no terms removes the filter"""
+        await self._set_filter(ctx, tiktokId, 'exclude', terms)
+
+    @sub_filter.command(name="show")
+    async def show_filter(self, ctx: commands.Context, tiktokId):
+        """Show the filters of a subscription"""
+        subs = await self.config.guild(ctx.guild).subscriptions()
+        for sub in subs:
+            if sub['id'] == tiktokId:
+                break
+        else:
+            await ctx.send("Subscription not found")
+            return
+
+        color = int(hex(int(ColorHash(tiktokId).hex.replace("#", ""), 16)), 0)
+        embed = discord.Embed(color=color, title=f"Filters of {tiktokId}")
+        embed.add_field(name='Include', value=', '.join(sub.get('include', [])) or 'Everything', inline=False)
+        embed.add_field(name='Exclude', value=', '.join(sub.get('exclude', [])) or 'Nothing', inline=False)
+        await ctx.send(embed=embed)
+
+    async def _set_filter(self, ctx: commands.Context, tiktokId, kind, terms):
+        terms = [term for term in terms if not is_empty_term(term)]
+        async with self.config.guild(ctx.guild).subscriptions() as subs:
+            for sub in subs:
+                if sub['id'] == tiktokId:
+                    sub[kind] = terms
+                    break
+            else:
+                await ctx.send("Subscription not found")
+                return
+
+        if terms:
+            await ctx.send(f"Videos of {tiktokId} matching {', '.join(terms)} will be {kind}d")
+        else:
+            await ctx.send(f"{kind.capitalize()} filter of {tiktokId} removed")
+
     @commands.guild_only()
     @tiktok.command()
     async def list(self, ctx: commands.Context):
@@ -643,6 +1049,40 @@ class TikTok(commands.Cog):
         await ctx.send(f"Proxy set to {proxy}")
         self.log.info(f"Proxy set to {proxy}")
 
+    @set.command()
+    @checks.is_owner()
+    async def loglevel(self, ctx: commands.Context, level: str):
+        """Set the log level of this cog"""
+        if not runtime.set_log_level("tiktok", level):
+            await ctx.send(f"Log level should be one of: {', '.join(runtime.LOG_LEVELS)}")
+            return
+        await self.config.log_level.set(level.upper())
+        await ctx.send(f"Log level set to {level.upper()}")
+
+    @set.command()
+    @checks.is_owner()
+    async def shards(self, ctx: commands.Context, partitions: int, shared_path: str = ''):
+        """Split polling between bot processes sharing `shared_path`
+
+        Every process has to use the same number of partitions, 1 disables sharding.
+        Takes effect after the cog is reloaded"""
+        partitions = max(1, partitions)
+        await self.config.shards.set(partitions)
+        await self.config.shared_path.set(shared_path)
+        if partitions > 1 and shared_path:
+            await ctx.send(f"Polling will be split in {partitions} partitions through {shared_path}, "
+                           f"reload the cog to apply")
+        else:
+            await ctx.send("Sharding disabled, reload the cog to apply")
+
+    @set.command()
+    @checks.is_owner()
+    async def spacing(self, ctx: commands.Context, seconds: float):
+        """Set the minimum delay in seconds between two TikTok requests"""
+        self.slow_lane.spacing = max(0.0, seconds)
+        await self.config.fetch_spacing.set(self.slow_lane.spacing)
+        await ctx.send(f"Requests will be at least {self.slow_lane.spacing}s apart")
+
     @set.command()
     @checks.is_owner()
     async def size(self, ctx: commands.Context, size):
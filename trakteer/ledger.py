@@ -0,0 +1,87 @@
+from datetime import datetime
+
+from owidlib import SQLiteStore
+
+PERIODS = ('day', 'week', 'month', 'all')
+# Marks the row holding the sum over every creator or supporter
+ANY = '*'
+
+
+def get_bucket(period, timestamp):
+    date = datetime.fromtimestamp(timestamp)
+    if period == 'day':
+        return date.strftime('%Y-%m-%d')
+    if period == 'week':
+        year, week, _ = date.isocalendar()
+        return '%d-W%02d' % (year, week)
+    if period == 'month':
+        return date.strftime('%Y-%m')
+    return 'all'
+
+
+class Ledger(SQLiteStore):
+    """Append-only SQLite ledger of Trakteer donations
+
+    Alongside the raw donations, running totals are kept per creator, supporter
+    and calendar period so leaderboards and totals never have to scan the ledger.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, """
+            CREATE TABLE IF NOT EXISTS donations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                creator TEXT NOT NULL,
+                supporter TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                price TEXT,
+                unit_icon TEXT,
+                message TEXT
+            );
+            CREATE INDEX IF NOT EXISTS donations_creator ON donations (creator, created);
+            CREATE INDEX IF NOT EXISTS donations_supporter ON donations (supporter, created);
+            CREATE INDEX IF NOT EXISTS donations_created ON donations (created);
+
+            CREATE TABLE IF NOT EXISTS totals (
+                creator TEXT NOT NULL,
+                period TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                supporter TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (creator, period, bucket, supporter)
+            );
+            CREATE INDEX IF NOT EXISTS totals_top ON totals (creator, period, bucket, amount);
+        """)
+
+    def record(self, creator, supporter, amount, price, unit_icon, message, created):
+        rows = [(_creator, period, get_bucket(period, created), _supporter, amount)
+                for period in PERIODS for _creator in (creator, ANY) for _supporter in (supporter, ANY)]
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO donations (created, creator, supporter, amount, price, unit_icon, message) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (created, creator, supporter, amount, price, unit_icon, message)
+            )
+            self.db.executemany(
+                "INSERT INTO totals (creator, period, bucket, supporter, amount, count) VALUES (?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (creator, period, bucket, supporter) "
+                "DO UPDATE SET amount = amount + excluded.amount, count = count + 1", rows
+            )
+
+    def top(self, creator, period, timestamp, limit=10):
+        """Supporters with the highest total in the period containing `timestamp`"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT supporter, amount, count FROM totals "
+                "WHERE creator = ? AND period = ? AND bucket = ? AND supporter != ? ORDER BY amount DESC LIMIT ?",
+                (creator or ANY, period, get_bucket(period, timestamp), ANY, limit)
+            ).fetchall()
+
+    def total(self, creator, period, timestamp):
+        """Total amount and number of donations in the period containing `timestamp`"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT amount, count FROM totals WHERE creator = ? AND period = ? AND bucket = ? AND supporter = ?",
+                (creator or ANY, period, get_bucket(period, timestamp), ANY)
+            ).fetchone()
+        return row or (0, 0)
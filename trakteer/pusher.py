@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import time
+
+import websockets
+
+PUSHER_URI = 'wss://socket.trakteer.id/app/2ae25d102cc6cd41100a'
+# Recommended by the Pusher protocol when the server does not say otherwise
+DEFAULT_ACTIVITY_TIMEOUT = 120
+PONG_TIMEOUT = 30
+
+
+class PusherConnection:
+    """A single Pusher websocket carrying the subscriptions of many channels
+
+    Meant to be driven by a `ConnectionSupervisor`, every channel in `channels`
+    is (re)subscribed each time the connection is established. Any event that is
+    not part of the Pusher protocol itself is handed over to `on_event` in its
+    own task so a slow handler never holds up the receive loop.
+
+    Pings are only sent once the connection has been idle for the server's
+    `activity_timeout`, a connection that does not answer within `PONG_TIMEOUT`
+    is closed so the supervisor can reconnect it.
+    """
+
+    def __init__(self, name, on_event, log=None, uri=PUSHER_URI):
+        self.name = name
+        self.on_event = on_event
+        self.log = log or logging.getLogger("red")
+        self.uri = uri
+        self.channels = set()
+        self.subscribed = set()
+        self.websocket = None
+        self.activity_timeout = DEFAULT_ACTIVITY_TIMEOUT
+        self.last_activity = 0.0
+        self.pings = 0
+        self.handlers = set()
+
+    async def connect(self):
+        websocket = await websockets.connect(self.uri)
+        try:
+            while True:
+                response = json.loads(await websocket.recv())
+                if response['event'] == 'pusher:connection_established':
+                    return websocket, json.loads(response['data'])
+        except BaseException:
+            await websocket.close()
+            raise
+
+    async def run(self, supervisor):
+        self.log.debug(f"Connecting {self.name} with {len(self.channels)} channel(s)")
+        websocket, established = await asyncio.wait_for(self.connect(), 30)
+        self.websocket = websocket
+        self.activity_timeout = established.get('activity_timeout') or DEFAULT_ACTIVITY_TIMEOUT
+        self.last_activity = time.monotonic()
+        heartbeat = asyncio.ensure_future(self.heartbeat(websocket))
+        try:
+            # Resubscribe everything in one go rather than waiting on each acknowledgement
+            for channel in list(self.channels):
+                await self.send('pusher:subscribe', {'channel': channel})
+            supervisor.connected()
+
+            while True:
+                response = json.loads(await websocket.recv())
+                self.last_activity = time.monotonic()
+                event = response['event']
+                if event == 'pusher_internal:subscription_succeeded':
+                    self.subscribed.add(response['channel'])
+                    self.log.debug('Successfully subscribed to %s' % response['channel'])
+                elif event == 'pusher:error':
+                    self.log.warning('%s' % response)
+                elif event == 'pusher:ping':
+                    await self.send('pusher:pong')
+                elif event != 'pusher:pong':
+                    self.dispatch(response)
+        finally:
+            heartbeat.cancel()
+            self.websocket = None
+            self.subscribed.clear()
+            await websocket.close()
+
+    def dispatch(self, response):
+        task = asyncio.ensure_future(self.on_event(response))
+        self.handlers.add(task)
+        task.add_done_callback(self.handler_done)
+
+    def handler_done(self, task):
+        self.handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f"Error while handling event: {repr(task.exception())}")
+
+    async def heartbeat(self, websocket):
+        while True:
+            idle = time.monotonic() - self.last_activity
+            if idle < self.activity_timeout:
+                await asyncio.sleep(self.activity_timeout - idle)
+                continue
+
+            pinged = time.monotonic()
+            self.pings += 1
+            await websocket.send(json.dumps({"event": "pusher:ping", "data": {}}))
+            await asyncio.sleep(PONG_TIMEOUT)
+            if self.last_activity < pinged:
+                self.log.warning(f"No pong received on {self.name} within {PONG_TIMEOUT}s, reconnecting")
+                await websocket.close()
+                return
+
+    async def send(self, event, data=None):
+        await self.websocket.send(json.dumps({"event": event, "data": data or {}}))
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+        if self.websocket is not None:
+            await self.send('pusher:subscribe', {'channel': channel})
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        self.subscribed.discard(channel)
+        if self.websocket is not None:
+            await self.send('pusher:unsubscribe', {'channel': channel})
@@ -1,10 +1,29 @@
-import logging
+import asyncio
+import re
+import time
+
 import discord
 import datetime
-import websockets
 import json
-import asyncio
-from redbot.core import commands
+from owidlib import ConnectionSupervisor, runtime
+from redbot.core import commands, checks, Config
+from redbot.core.data_manager import cog_data_path
+
+from .ledger import Ledger, PERIODS
+from .pusher import PusherConnection, PUSHER_URI
+
+# Pusher has no hard limit on subscriptions per connection, shard anyway so a
+# single dropped socket does not silence every creator at once
+CHANNELS_PER_CONNECTION = 100
+UNIQUE_ID = 0x7472616B
+
+
+def parse_amount(price):
+    """Turn a formatted price such as `Rp 25.000` into an integer amount"""
+    match = re.search(r'Rp\s*([\d.,]+)', price or '') or re.search(r'([\d.,]+)', price or '')
+    if not match:
+        return 0
+    return int(re.sub(r'[.,]\d{1,2}$', '', match.group(1)).replace('.', '').replace(',', '') or 0)
 
 
 class Trakteer(commands.Cog):
@@ -13,85 +32,351 @@ class Trakteer(commands.Cog):
         super().__init__(*args, **kwargs)
 
         self.bot = bot
-        self.keys = [{'channelId': 803626623596363786,
-                      'channelKey': 'creator-stream.n8rx3ldzx7o4wamg.trstream-t6ZPmsNYQM061wcg5slw',
-                      'channelUrl': 'https://trakteer.id/overwatch-idn',
-                      'debug': True},
-                     {'channelId': 842043854294220840,
-                      'channelKey': 'creator-stream.6am740y9vaj5z0vp.trstream-6Oml9NSUZMm4yuQK5Z7H',
-                      'channelUrl': 'https://trakteer.id/itspurinch',
-                      'debug': True}]
-        self.tasks = []
-        self.websockets = []
-        self.log = logging.getLogger("red")
+        self.config = Config.get_conf(self, identifier=UNIQUE_ID, force_registration=True)
+        self.config.register_global(creators=[{'channelId': 803626623596363786,
+                                               'channelKey': 'creator-stream.n8rx3ldzx7o4wamg.trstream-t6ZPmsNYQM061wcg5slw',
+                                               'channelUrl': 'https://trakteer.id/overwatch-idn',
+                                               'debug': True},
+                                              {'channelId': 842043854294220840,
+                                               'channelKey': 'creator-stream.6am740y9vaj5z0vp.trstream-6Oml9NSUZMm4yuQK5Z7H',
+                                               'channelUrl': 'https://trakteer.id/itspurinch',
+                                               'debug': True}],
+                                    coalesce_window=0.0, large_donation=100000, log_level='INFO')
+        runtime.acquire()
+        self.keys = []
+        self.log = runtime.get_logger("trakteer")
+        self.routes = {}
+        self.pusher_uri = PUSHER_URI
+        self.connections = []
+        self.supervisors = []
+        self.coalesce_window = 0.0
+        self.large_donation = 100000
+        self.ledger = None
+        self.pending = {}
+        self.flushes = {}
+        self.stats = {'received': 0, 'sent': 0, 'embeds': 0, 'coalesced': 0, 'total_delay': 0.0, 'max_delay': 0.0}
+        self.main_task = self.bot.loop.create_task(self.initialize())
+
+    async def initialize(self):
+        runtime.set_log_level("trakteer", await self.config.log_level())
+        self.keys = await self.config.creators()
+        self.coalesce_window = await self.config.coalesce_window()
+        self.large_donation = await self.config.large_donation()
+        self.ledger = await runtime.run_io(Ledger, cog_data_path(self) / "ledger.db")
         for key in self.keys:
-            task = self.bot.loop.create_task(self.websocket_thread(key))
-            self.tasks.append(task)
-
-        self.log.debug("[trakteer] Trakteer threads initialized!")
-
-    async def connect(self, key):
-        uri = 'wss://socket.trakteer.id/app/2ae25d102cc6cd41100a'
-        self.log.debug("[trakteer] Attempting to connect for key %s" % key['channelKey'])
-        websocket = await websockets.connect(uri)
-        while True:
-            response = json.loads(await websocket.recv())
-            if response['event'] == 'pusher:connection_established':
-                await websocket.send(json.dumps({
-                    "event": "pusher:subscribe",
-                    "data": {"channel": key['channelKey']}
-                }))
-
-                if key['debug']:
-                    await websocket.send(json.dumps({
-                        "event": "pusher:subscribe",
-                        "data": {"channel": key['channelKey'].replace('creator-stream', 'creator-stream-test')}
-                    }))
-                return websocket
-
-    async def websocket_thread(self, key):
+            for channel in self.get_channels(key):
+                self.routes[channel] = (key, self.is_test_channel(channel))
+
+        channels = list(self.routes)
+        for i in range(0, len(channels), CHANNELS_PER_CONNECTION):
+            connection = self.add_connection()
+            connection.channels.update(channels[i:i + CHANNELS_PER_CONNECTION])
+
+        self.log.debug("Trakteer connections initialized!")
+
+    @staticmethod
+    def get_channels(key):
+        channels = [key['channelKey']]
+        if key['debug']:
+            channels.append(key['channelKey'].replace('creator-stream', 'creator-stream-test'))
+        return channels
+
+    @staticmethod
+    def is_test_channel(channel):
+        """Whether a channel carries the donations sent with the overlay's test button"""
+        return channel.startswith('creator-stream-test')
+
+    @staticmethod
+    def get_name(key):
+        return key['channelUrl'].rstrip('/').rsplit('/', 1)[-1]
+
+    def add_connection(self):
+        connection = PusherConnection(f"trakteer:{len(self.connections)}", self.on_event, self.log,
+                                      self.pusher_uri)
+        supervisor = ConnectionSupervisor(connection.name, connection.run, self.log)
+        supervisor.start(self.bot.loop)
+        self.connections.append(connection)
+        self.supervisors.append(supervisor)
+        return connection
+
+    async def subscribe(self, key):
+        """Subscribe a creator on the live connections, opening a new one only when all of them are full"""
+        for channel in self.get_channels(key):
+            self.routes[channel] = (key, self.is_test_channel(channel))
+            connection = min(self.connections, key=lambda c: len(c.channels), default=None)
+            if connection is None or len(connection.channels) >= CHANNELS_PER_CONNECTION:
+                connection = self.add_connection()
+            await connection.subscribe(channel)
+
+    async def unsubscribe(self, key):
+        for channel in self.get_channels(key):
+            self.routes.pop(channel, None)
+            for connection in self.connections:
+                if channel in connection.channels:
+                    await connection.unsubscribe(channel)
+
+    async def on_event(self, response):
+        if response['event'] != 'Illuminate\\Notifications\\Events\\BroadcastNotificationCreated':
+            self.log.debug('%s' % response)
+            return
+
+        route = self.routes.get(response.get('channel'))
+        if route is None:
+            self.log.warning('Received donation for unknown channel %s' % response.get('channel'))
+            return
+
+        key, is_test = route
+        donator = json.loads(response['data'])
+        self.stats['received'] += 1
+        donation = (time.monotonic(), donator)
+        try:
+            # Large donations always get their own alert straight away
+            if self.coalesce_window <= 0 or parse_amount(donator.get('price')) >= self.large_donation:
+                await self.send_donations(key, [donation])
+                return
+
+            name = self.get_name(key)
+            self.pending.setdefault(name, (key, []))[1].append(donation)
+            if name not in self.flushes:
+                self.flushes[name] = self.track(self.flush(key))
+        finally:
+            # Test donations would only inflate the leaderboards
+            if not is_test:
+                await self.record_donation(key, donator)
+
+    async def record_donation(self, key, donator):
+        """Add a donation to the ledger, failing to do so must never cost an alert"""
         try:
-            websocket = await asyncio.wait_for(self.connect(key), 30)
-            self.websockets.append(websocket)
-            while True:
-                response = json.loads(await websocket.recv())
-                if response['event'] == 'pusher_internal:subscription_succeeded':
-                    self.log.debug('[trakteer] Successfully subscribed to %s' % response['channel'])
-
-                elif response['event'] != 'pusher:pong':
-                    self.log.debug('[trakteer] %s' % response)
-
-                if response['event'] == 'Illuminate\\Notifications\\Events\\BroadcastNotificationCreated':
-                    donator = json.loads(response['data'])
-
-                    click_here = f"[Klik disini untuk ikut mentraktir!]({key.get('channelUrl')})"
-                    donate_info = f"🎁 Baru saja memberikan {donator['price']}"
-
-                    embed = discord.Embed(color=0xEE2222, url=key.get('channelUrl'))
-                    embed.timestamp = datetime.datetime.utcnow()
-                    if 'supporter_message' in donator:
-                        embed.description = donator['supporter_message']
-                    embed.add_field(name=donate_info, value=click_here, inline=False)
-                    embed.set_author(name=donator['supporter_name'], url=key.get('channelUrl'),
-                                     icon_url=donator['supporter_avatar'])
-                    embed.set_thumbnail(url=donator['unit_icon'])
-
-                    await self.bot.get_channel(key['channelId']).send(embed=embed)
-                else:
-                    await websocket.send(json.dumps({"event": "pusher:ping", "data": {}}))
-                    await asyncio.sleep(1)
-        except asyncio.exceptions.TimeoutError:
-            self.log.warning("[trakteer] Attempting to reconnect due to connection timeout")
-            await self.websocket_thread(key)
-        except websockets.exceptions.ConnectionClosed:
-            self.log.warning("[trakteer] Attempting to reconnect due to connection closed")
-            await self.websocket_thread(key)
+            await runtime.run_io(self.ledger.record, self.get_name(key), donator['supporter_name'],
+                                 parse_amount(donator.get('price')), donator.get('price'),
+                                 donator.get('unit_icon'), donator.get('supporter_message'), time.time())
         except Exception as e:
-            self.log.warning("[trakteer] Attempting to reconnect due to: " + str(e))
-            await self.websocket_thread(key)
+            self.log.error(f"Unable to record donation of {donator.get('supporter_name')}: {repr(e)}")
+
+    async def flush(self, key):
+        name = self.get_name(key)
+        try:
+            await asyncio.sleep(self.coalesce_window)
+        finally:
+            del self.flushes[name]
+        _, donations = self.pending.pop(name, (key, []))
+        await self.send_donations(key, donations)
+
+    def track(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(self.flush_done)
+        return task
+
+    def flush_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f"Unable to send coalesced donations: {repr(task.exception())}")
+
+    async def send_donations(self, key, donations):
+        if not donations:
+            return
+        if len(donations) == 1:
+            embed = self.build_embed(key, donations[0][1])
+        else:
+            embed = self.build_summary_embed(key, [donator for _, donator in donations])
+            self.stats['coalesced'] += len(donations)
+
+        await self.bot.get_channel(key['channelId']).send(embed=embed)
+
+        now = time.monotonic()
+        self.stats['embeds'] += 1
+        self.stats['sent'] += len(donations)
+        for received, _ in donations:
+            self.stats['total_delay'] += now - received
+            self.stats['max_delay'] = max(self.stats['max_delay'], now - received)
+
+    @staticmethod
+    def build_embed(key, donator):
+        click_here = f"[Klik disini untuk ikut mentraktir!]({key.get('channelUrl')})"
+        donate_info = f"🎁 Baru saja memberikan {donator['price']}"
+
+        embed = discord.Embed(color=0xEE2222, url=key.get('channelUrl'))
+        embed.timestamp = datetime.datetime.utcnow()
+        if 'supporter_message' in donator:
+            embed.description = donator['supporter_message']
+        embed.add_field(name=donate_info, value=click_here, inline=False)
+        embed.set_author(name=donator['supporter_name'], url=key.get('channelUrl'),
+                         icon_url=donator['supporter_avatar'])
+        embed.set_thumbnail(url=donator['unit_icon'])
+        return embed
+
+    @staticmethod
+    def build_summary_embed(key, donators):
+        click_here = f"[Klik disini untuk ikut mentraktir!]({key.get('channelUrl')})"
+        total = sum(parse_amount(donator.get('price')) for donator in donators)
+
+        embed = discord.Embed(color=0xEE2222, url=key.get('channelUrl'))
+        embed.timestamp = datetime.datetime.utcnow()
+        embed.title = f"🎁 {len(donators)} traktiran baru, total Rp {total:,}".replace(',', '.')
+        lines = [f"**{donator['supporter_name']}** - {donator['price']}" for donator in donators]
+        embed.description = "\n".join(lines[:20])
+        if len(lines) > 20:
+            embed.description += f"\n... dan {len(lines) - 20} lainnya"
+        embed.add_field(name="\u200b", value=click_here, inline=False)
+        embed.set_thumbnail(url=donators[-1]['unit_icon'])
+        return embed
 
     def cog_unload(self):
-        for task in self.tasks:
-            task.cancel()
-        for socket in self.websockets:
-            self.bot.loop.create_task(socket.close())
+        self.main_task.cancel()
+        for flush in list(self.flushes.values()):
+            flush.cancel()
+        # Donations still waiting for their coalescing window are sent right away rather than dropped
+        for key, donations in self.pending.values():
+            self.log.info(f"Sending {len(donations)} pending donation(s) of {self.get_name(key)} before unloading")
+            self.track(self.send_donations(key, donations))
+        self.pending = {}
+        if self.ledger:
+            self.ledger.close()
+        runtime.release()
+        for supervisor in self.supervisors:
+            supervisor.stop()
+
+    @commands.group()
+    async def trakteer(self, ctx: commands.Context) -> None:
+        """
+        Trakteer commands
+        """
+        pass
+
+    @trakteer.command()
+    @checks.is_owner()
+    async def add(self, ctx: commands.Context, channel: discord.TextChannel, channel_key: str, channel_url: str,
+                  debug: bool = False):
+        """Post donations of a creator to a Discord channel
+
+        `channel_key` is the `creator-stream.*` key found in the creator's stream overlay link"""
+        if not channel_key.startswith('creator-stream.'):
+            await ctx.send("Invalid channel key, it should start with `creator-stream.`")
+            return
+
+        key = {'channelId': channel.id, 'channelKey': channel_key, 'channelUrl': channel_url, 'debug': debug}
+        async with self.config.creators() as creators:
+            if any(self.get_name(creator) == self.get_name(key) for creator in creators):
+                await ctx.send(f"{self.get_name(key)} has already been added")
+                return
+            creators.append(key)
+
+        self.keys.append(key)
+        await self.subscribe(key)
+        await ctx.send(f"Donations of {self.get_name(key)} will be posted to <#{channel.id}>")
+
+    @trakteer.command()
+    @checks.is_owner()
+    async def remove(self, ctx: commands.Context, creator: str):
+        """Stop posting donations of a creator, by name or trakteer.id link"""
+        name = creator.rstrip('/').rsplit('/', 1)[-1]
+        async with self.config.creators() as creators:
+            removed = [key for key in creators if self.get_name(key) == name]
+            creators[:] = [key for key in creators if self.get_name(key) != name]
+
+        if not removed:
+            await ctx.send("Creator not found")
+            return
+
+        self.keys[:] = [key for key in self.keys if self.get_name(key) != name]
+        for key in removed:
+            await self.unsubscribe(key)
+        await ctx.send(f"Donations of {name} will no longer be posted")
+
+    @trakteer.command(name="list")
+    @checks.is_owner()
+    async def list_creators(self, ctx: commands.Context):
+        """List creators whose donations are posted"""
+        if not self.keys:
+            await ctx.send("No creators yet - try adding some!")
+            return
+
+        embed = discord.Embed(color=0xEE2222, title='Trakteer creators')
+        embed.description = "\n".join(f"○ [{self.get_name(key)}]({key['channelUrl']}) in <#{key['channelId']}>"
+                                      + (" (debug)" if key['debug'] else "") for key in self.keys)
+        await ctx.send(embed=embed)
+
+    @trakteer.command()
+    @checks.is_owner()
+    async def coalesce(self, ctx: commands.Context, window: float, large_donation: int = None):
+        """Combine donations arriving within `window` seconds into one alert, 0 disables it
+
+        Donations of at least `large_donation` rupiah are always posted on their own"""
+        self.coalesce_window = max(0.0, window)
+        await self.config.coalesce_window.set(self.coalesce_window)
+        if large_donation is not None:
+            self.large_donation = large_donation
+            await self.config.large_donation.set(large_donation)
+
+        if self.coalesce_window:
+            await ctx.send(f"Donations within {self.coalesce_window}s will be combined, "
+                           f"except those of at least Rp {self.large_donation}")
+        else:
+            await ctx.send("Every donation will be posted on its own")
+
+    @trakteer.command()
+    @checks.is_owner()
+    async def loglevel(self, ctx: commands.Context, level: str):
+        """Set the log level of this cog"""
+        if not runtime.set_log_level("trakteer", level):
+            await ctx.send(f"Log level should be one of: {', '.join(runtime.LOG_LEVELS)}")
+            return
+        await self.config.log_level.set(level.upper())
+        await ctx.send(f"Log level set to {level.upper()}")
+
+    @trakteer.command(name="stats")
+    @checks.is_owner()
+    async def trakteer_stats(self, ctx: commands.Context):
+        """Show donation alert statistics"""
+        sent = self.stats['sent']
+        embed = discord.Embed(color=0xEE2222, title='Trakteer statistics')
+        embed.add_field(name='Events received', value=str(self.stats['received']))
+        embed.add_field(name='Donations sent', value=str(sent))
+        embed.add_field(name='Embeds sent', value=str(self.stats['embeds']))
+        embed.add_field(name='Coalesced', value=str(self.stats['coalesced']))
+        embed.add_field(name='Pending', value=str(sum(len(donations) for _, donations in self.pending.values())))
+        embed.add_field(name='Average delay', value=f"{self.stats['total_delay'] / sent if sent else 0:.2f}s")
+        embed.add_field(name='Max delay', value=f"{self.stats['max_delay']:.2f}s")
+        await ctx.send(embed=embed)
+
+    @trakteer.command()
+    async def top(self, ctx: commands.Context, period: str = 'month', creator: str = None):
+        """Show the top supporters of this `day`, `week`, `month` or of `all` time
+
+        If no creator is specified, donations to every creator are counted"""
+        if period not in PERIODS:
+            await ctx.send(f"Period should be one of: {', '.join(PERIODS)}")
+            return
+
+        rows = await runtime.run_io(self.ledger.top, creator, period, time.time())
+        if not rows:
+            await ctx.send("No donations yet in this period")
+            return
+
+        embed = discord.Embed(color=0xEE2222, title=f"Top supporters ({period}{f', {creator}' if creator else ''})")
+        embed.description = "\n".join(f"**{i}.** {supporter} - Rp {amount:,} ({count}x)".replace(',', '.')
+                                      for i, (supporter, amount, count) in enumerate(rows, start=1))
+        await ctx.send(embed=embed)
+
+    @trakteer.command()
+    async def total(self, ctx: commands.Context, period: str = 'month', creator: str = None):
+        """Show the donation total of this `day`, `week`, `month` or of `all` time
+
+        If no creator is specified, donations to every creator are counted"""
+        if period not in PERIODS:
+            await ctx.send(f"Period should be one of: {', '.join(PERIODS)}")
+            return
+
+        amount, count = await runtime.run_io(self.ledger.total, creator, period, time.time())
+        embed = discord.Embed(color=0xEE2222, title=f"Donation total ({period}{f', {creator}' if creator else ''})")
+        embed.description = f"Rp {amount:,} from {count} donation(s)".replace(',', '.')
+        await ctx.send(embed=embed)
+
+    @trakteer.command()
+    @checks.is_owner()
+    async def status(self, ctx: commands.Context):
+        """Show the state of the Trakteer connections"""
+        embed = discord.Embed(color=0xEE2222, title='Trakteer connections')
+        for connection, supervisor in zip(self.connections, self.supervisors):
+            embed.add_field(name=f"{supervisor.name} ({len(connection.subscribed)}/{len(connection.channels)} "
+                                 f"channels)", value=supervisor.describe(), inline=False)
+        await ctx.send(embed=embed)